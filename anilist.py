@@ -0,0 +1,169 @@
+"""Клиент AniList GraphQL для каталога.
+
+Один keep-alive пул соединений на процесс, общий token bucket под
+поминутную квоту AniList, пауза по Retry-After на 429, повтор с backoff на
+5xx и сетевых ошибках. Одновременные запросы одной страницы идут одним
+HTTP-вызовом (singleflight), а ответ ещё cache_ttl секунд отдаётся из памяти.
+
+    client = AniListClient(url="http://127.0.0.1:8000/graphql")
+    media = client.fetch_page(1)
+
+URL задаётся в конструкторе, поэтому клиент проверяется на локальном
+фейковом GraphQL-сервере (см. bench/load.py).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+API_URL = "https://graphql.anilist.co"
+
+MEDIA_QUERY = """
+    query ($page: Int, $perPage: Int) {
+      Page(page: $page, perPage: $perPage) {
+        media(type: ANIME, sort: POPULARITY_DESC) {
+          id
+          title { romaji }
+          startDate { year }
+          genres
+          studios(isMain: true) { nodes { name } }
+          characters(perPage: 5, sort: ROLE) {
+            nodes { name { full } }
+          }
+          coverImage { extraLarge large medium color }
+          bannerImage
+        }
+      }
+    }
+"""
+
+RETRY_AFTER_DEFAULT_SEC = 60
+RETRY_AFTER_MAX_SEC = 120
+
+class AniListError(Exception):
+    pass
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class AniListClient:
+    """bucket — объект с reserve() -> секунды ожидания (TokenBucket из app.py);
+    None — без ограничения. on_request(seconds, outcome) вызывается на каждый
+    HTTP-вызов: outcome = ok / error / rate_limited."""
+
+    def __init__(self, url=API_URL, bucket=None, cache_ttl=60, cache_size=256,
+                 timeout=15, retries=3, pool_size=4, on_request=None):
+        self.url = url
+        self.bucket = bucket
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self.retries = retries
+        self.on_request = on_request
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.stats = {"http": 0, "cache_hits": 0, "coalesced": 0, "retries": 0, "rate_limited": 0}
+        self._cache = OrderedDict()  # (page, per_page) -> (истекает, media)
+        self._flights = {}
+        self._blocked_until = 0.0  # monotonic: до этого момента AniList просил не приходить
+        self._lock = threading.Lock()
+
+    def fetch_page(self, page, per_page=50):
+        key = (page, per_page)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                self.stats["cache_hits"] += 1
+                return cached[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._post({"page": page, "perPage": per_page})["Page"]["media"]
+            with self._lock:
+                self._cache[key] = (time.monotonic() + self.cache_ttl, flight.result)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _wait_turn(self):
+        with self._lock:
+            blocked = self._blocked_until - time.monotonic()
+        wait = max(blocked, self.bucket.reserve() if self.bucket else 0.0)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _post(self, variables):
+        for attempt in range(self.retries + 1):
+            self._wait_turn()
+            start = time.monotonic()
+            outcome = "error"
+            try:
+                resp = self.session.post(self.url, json={"query": MEDIA_QUERY, "variables": variables},
+                                         timeout=self.timeout)
+                if resp.status_code == 429:
+                    outcome = "rate_limited"
+                    self._rate_limited(resp)
+                elif resp.status_code < 500:
+                    if not resp.ok and "json" not in resp.headers.get("Content-Type", ""):
+                        resp.raise_for_status()
+                    body = resp.json()
+                    if body.get("data") is None:
+                        raise AniListError(f"AniList {resp.status_code}: {body.get('errors')}")
+                    outcome = "ok"
+                    return body["data"]
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            finally:
+                with self._lock:
+                    self.stats["http"] += 1
+                if self.on_request:
+                    self.on_request(time.monotonic() - start, outcome)
+            if attempt < self.retries:
+                with self._lock:
+                    self.stats["retries"] += 1
+                if outcome == "error":
+                    time.sleep(2 ** attempt)  # 5xx или сеть: 1, 2, 4 сек
+        raise AniListError(f"AniList не ответил за {self.retries + 1} попыток")
+
+    def _rate_limited(self, resp):
+        try:
+            retry_after = float(resp.headers.get("Retry-After", RETRY_AFTER_DEFAULT_SEC))
+        except ValueError:
+            retry_after = RETRY_AFTER_DEFAULT_SEC
+        with self._lock:
+            self.stats["rate_limited"] += 1
+            until = time.monotonic() + min(retry_after, RETRY_AFTER_MAX_SEC)
+            self._blocked_until = max(self._blocked_until, until)
@@ -1,9 +1,41 @@
 import os
+SERVER = os.getenv("SERVER", "dev")  # dev — встроенный сервер Flask, gevent — greenlet'ы на event loop
+if SERVER == "gevent":
+    # до остальных импортов: сокеты, локи, очереди и sleep становятся кооперативными,
+    # long-poll /api/get_state и вызовы Telegram/AniList держат greenlet, а не поток
+    from gevent import monkey
+    monkey.patch_all()
+import re
+import sys
 import time
+import json
+import gzip
+import io
+import mimetypes
 import random
+import sqlite3
+import heapq
+import bisect
+import contextlib
+import queue
+import itertools
+import threading
 import requests
-from flask import Flask, request, jsonify
+from dataclasses import dataclass, field, fields, asdict
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify, send_file, g, has_request_context
 import telebot
+import anilist
+try:
+    import fcntl  # нет на Windows: там каталог обновляет каждый процесс
+except ImportError:
+    fcntl = None
+try:
+    from PIL import Image  # необязательно: без Pillow картинки отдаются как есть
+except ImportError:
+    Image = None
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
 
 # === Конфигурация ===
@@ -14,178 +46,1677 @@ if not TOKEN:
 WEBAPP_BASE = os.getenv("WEBAPP_BASE", "https://example.com/web/")  # ваш публичный URL c /web/
 
 # Константы
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")  # memory | sqlite | journal
+STATE_DB = os.getenv("STATE_DB", "state.sqlite3")
+STATE_JOURNAL_DIR = os.getenv("STATE_JOURNAL_DIR", "state_journal")
+
 MIN_TIMER = 5
 MAX_TIMER = 300
 DEADLINE_SLOP_SEC = 0.3  # "фора" к дедлайну
+LONG_POLL_MAX_SEC = 25   # сколько максимум держим /api/get_state?since_rev=N
+STATE_GZIP_MIN_BYTES = 2048  # меньше — не сжимаем, выигрыша нет
+GEVENT_MAX_CONNECTIONS = int(os.getenv("GEVENT_MAX_CONNECTIONS", 10000))  # одновременных соединений при SERVER=gevent
 
-bot = telebot.TeleBot(TOKEN, parse_mode="Markdown")
+# threaded=False: хендлеры выполняются в наших воркерах апдейтов (см. ниже),
+# которые и гарантируют порядок внутри чата
+bot = telebot.TeleBot(TOKEN, parse_mode="Markdown", threaded=False)
 app = Flask(__name__, static_url_path='', static_folder='web')
 
+# === Метрики ===
+# Гистограммы и счётчики живут в памяти процесса и отдаются на /metrics в
+# текстовом формате Prometheus. Запись — бинпоиск по корзинам и инкремент
+# под локом метрики. Заодно по фазам запроса (lock, wait, question, telegram,
+# anilist, serialize) копится разбивка для лога медленных запросов.
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SLOW_REQUEST_SEC = float(os.getenv("SLOW_REQUEST_SEC", 1.0))
+
+metrics_registry = []
+
+def metric_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.values = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = list(self.values.items())
+        return [f"{self.name}{metric_labels(self.labels, k)} {v}" for k, v in items]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=METRIC_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self.series = {}  # значения меток -> [попадания по корзинам..., +Inf, сумма]
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def render(self):
+        with self._lock:
+            items = [(k, list(s)) for k, s in self.series.items()]
+        lines = []
+        for labels, s in items:
+            total = 0
+            for le, n in zip(self.buckets + ("+Inf",), s[:-1]):
+                total += n
+                lines.append(f"{self.name}_bucket{metric_labels(self.labels + ('le',), labels + (le,))} {total}")
+            lines.append(f"{self.name}_sum{metric_labels(self.labels, labels)} {s[-1]:.6f}")
+            lines.append(f"{self.name}_count{metric_labels(self.labels, labels)} {total}")
+        return lines
+
+class Collected:
+    """Метрика, которая при отдаче читает уже существующую статистику."""
+    def __init__(self, name, doc, kind, collect, labels=()):
+        self.name, self.doc, self.kind, self.collect, self.labels = name, doc, kind, collect, labels
+        metrics_registry.append(self)
+
+    def render(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{metric_labels(self.labels, k if isinstance(k, tuple) else (k,))} {v}"
+                for k, v in values.items()]
+
+http_seconds = Histogram("quiz_http_request_seconds", "Время обработки HTTP-запроса", ("route", "method", "status"))
+anilist_seconds = Histogram("quiz_anilist_request_seconds", "Запросы к AniList", ("outcome",))
+telegram_seconds = Histogram("quiz_telegram_request_seconds", "Вызовы Telegram Bot API", ("method", "outcome"))
+question_seconds = Histogram("quiz_question_build_seconds", "Сборка вопроса по типу", ("type",))
+question_attempts = Counter("quiz_question_attempts_total", "Попытки собрать вопрос", ("type", "result"))
+lock_wait_seconds = Histogram("quiz_state_lock_wait_seconds", "Ожидание блокировки чата")
+
+def record_phase(name, seconds):
+    if has_request_context():
+        phases = g.get("phases")
+        if phases is not None:
+            phases[name] = phases.get(name, 0.0) + seconds
+
+@contextlib.contextmanager
+def timed(histogram, phase, *labels):
+    """Меряет блок: метка outcome = ok/error дописывается последней."""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        elapsed = time.perf_counter() - start
+        histogram.observe(elapsed, *labels, outcome)
+        record_phase(phase, elapsed)
+
+@app.before_request
+def metrics_request_start():
+    g.request_started = time.perf_counter()
+    g.phases = {}
+
+@app.after_request
+def metrics_request_finish(resp):
+    elapsed = time.perf_counter() - g.request_started
+    route = request.endpoint or "unmatched"  # имя функции, а не правило: в пути вебхука токен
+    http_seconds.observe(elapsed, route, request.method, str(resp.status_code))
+    phases = g.phases
+    if elapsed - phases.get("wait", 0.0) >= SLOW_REQUEST_SEC:  # ожидание long-poll — не медленность
+        other = elapsed - sum(phases.values())
+        breakdown = ", ".join(f"{k} {v:.3f}" for k, v in phases.items())
+        print(f"🐢 Медленный запрос {request.method} {route}: {elapsed:.3f} с ({breakdown + ', ' if breakdown else ''}прочее {other:.3f})")
+    return resp
+
+@app.route("/metrics")
+def metrics_api():
+    lines = []
+    for m in metrics_registry:
+        lines.append(f"# HELP {m.name} {m.doc}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        try:
+            lines.extend(m.render())
+        except Exception as e:
+            print(f"❌ Метрика {m.name}: {e}")
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
 # === Маршруты для web ===
 @app.route('/')
 def index():
     return "✅ Bot is running!", 200
 
+# Собранная статика (python build_web.py) лежит в web/dist: ассеты с хешем
+# в имени отдаются навсегда-кешируемыми, в предсжатом варианте под
+# Accept-Encoding. Без сборки — исходники из web/, как раньше.
+WEB_DIST = os.path.join(app.static_folder, "dist")
+HASHED_ASSET = re.compile(r"app\.[0-9a-f]{10}\.(js|css)")
+STATIC_MAX_AGE_SEC = 365 * 24 * 3600
+STATIC_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+def serve_dist_asset(name):
+    path = os.path.join(WEB_DIST, name)
+    mimetype = mimetypes.guess_type(name)[0]
+    accepted = request.headers.get("Accept-Encoding", "")
+    encoding = next(((enc, ext) for enc, ext in STATIC_ENCODINGS
+                     if enc in accepted and os.path.exists(path + ext)), None)
+    if encoding:
+        resp = send_file(path + encoding[1], mimetype=mimetype, max_age=STATIC_MAX_AGE_SEC)
+        resp.headers["Content-Encoding"] = encoding[0]
+    else:
+        resp = send_file(path, mimetype=mimetype, max_age=STATIC_MAX_AGE_SEC)
+    resp.cache_control.immutable = True
+    resp.vary.add("Accept-Encoding")
+    return resp
+
 @app.route('/web/<path:path>')
 def serve_web(path):
+    if HASHED_ASSET.fullmatch(path) and os.path.exists(os.path.join(WEB_DIST, path)):
+        return serve_dist_asset(path)
     return app.send_static_file(path)
 
+def bootstrap_state(chat_id, user_id):
+    """Тело get_state для встраивания в index.html или None, если игры нет."""
+    with reading_state(chat_id) as gs:
+        if not gs:
+            return None
+        role = "admin" if gs.admin_id == user_id else "player"
+        return cached_state_body(gs, chat_id, user_id, role, False)
+
+def bootstrap_script(body):
+    # "<" экранируем, чтобы имена игроков вроде "</script>" не закрыли тег
+    data = body.decode("utf-8").replace("<", "\\u003c")
+    return f'<script id="bootstrap-state" type="application/json">{data}</script>\n'
+
 @app.route('/web/')
 def serve_web_index():
-    return app.send_static_file('index.html')
+    index_path = os.path.join(WEB_DIST, "index.html")
+    if not os.path.exists(index_path):
+        index_path = os.path.join(app.static_folder, "index.html")
+    try:
+        body = bootstrap_state(int(request.args["chat_id"]), int(request.args["user_id"]))
+    except (KeyError, ValueError):
+        body = None
+    except Exception as e:
+        print(f"❌ /web/ bootstrap error: {e}")
+        body = None
+    if body is None:
+        resp = send_file(index_path, max_age=0)  # имена ассетов меняются с каждой сборкой
+        resp.cache_control.no_cache = True
+        return resp
+    # состояние уже внутри страницы — мини-апп рисует экран без первого /api/get_state
+    with open(index_path, encoding="utf-8") as f:
+        html = f.read().replace("</head>", bootstrap_script(body) + "</head>", 1)
+    resp = Response(html, mimetype="text/html")
+    resp.cache_control.no_store = True
+    resp.cache_control.private = True
+    return resp
+
+# === Приём апдейтов Telegram ===
+# Вебхук только кладёт апдейт в очередь и сразу отвечает 200, чтобы Telegram
+# не ретраил медленные хендлеры. Апдейты одного чата попадают в один шард
+# и обрабатываются строго по порядку.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 4))
+UPDATE_QUEUE_MAX = 1000     # на шард; при переполнении отвечаем 503 — Telegram повторит позже
+UPDATE_DEDUP_SIZE = 10000   # сколько последних update_id помним
+
+update_queues = [queue.Queue(maxsize=UPDATE_QUEUE_MAX) for _ in range(UPDATE_WORKERS)]
+seen_update_ids = OrderedDict()
+update_stats = {"received": 0, "duplicates": 0, "rejected": 0, "processed": 0, "failed": 0, "last_lag_sec": 0.0}
+_updates_lock = threading.Lock()
+
+def update_chat_key(data):
+    for kind in ("message", "edited_message", "channel_post", "my_chat_member", "chat_member"):
+        chat = (data.get(kind) or {}).get("chat")
+        if chat:
+            return chat["id"]
+    cq = data.get("callback_query")
+    if cq:
+        chat = (cq.get("message") or {}).get("chat")
+        return chat["id"] if chat else cq["from"]["id"]
+    return data.get("update_id", 0)
+
+def enqueue_update(raw):
+    data = json.loads(raw)
+    update_id = data.get("update_id")
+    with _updates_lock:
+        update_stats["received"] += 1
+        if update_id in seen_update_ids:
+            update_stats["duplicates"] += 1
+            return True
+        shard = update_queues[hash(update_chat_key(data)) % UPDATE_WORKERS]
+        try:
+            shard.put_nowait((time.time(), data))
+        except queue.Full:
+            update_stats["rejected"] += 1
+            return False
+        seen_update_ids[update_id] = True
+        if len(seen_update_ids) > UPDATE_DEDUP_SIZE:
+            seen_update_ids.popitem(last=False)
+    return True
+
+def update_worker(q):
+    while True:
+        received_at, data = q.get()
+        result = "processed"
+        try:
+            bot.process_new_updates([telebot.types.Update.de_json(data)])
+        except Exception as e:
+            result = "failed"
+            print(f"❌ Ошибка обработки апдейта {data.get('update_id')}: {e}")
+        finally:
+            with _updates_lock:  # воркеров UPDATE_WORKERS — += без лока теряет инкременты
+                update_stats[result] += 1
+                update_stats["last_lag_sec"] = round(time.time() - received_at, 3)
+            q.task_done()
+
+for _i, _q in enumerate(update_queues):
+    threading.Thread(target=update_worker, args=(_q,), name=f"updates-{_i}", daemon=True).start()
 
 # Вебхук (если используете вебхук)
 @app.route('/webhook/', methods=['POST', 'GET'])
 def webhook_handler():
     if request.method == 'POST':
-        update = telebot.types.Update.de_json(request.stream.read().decode("utf-8"))
-        bot.process_new_updates([update])
+        if not enqueue_update(request.stream.read().decode("utf-8")):
+            return "busy", 503
         return "ok", 200
     else:
         return "Webhook endpoint", 200
 
 @app.route(f"/{TOKEN}", methods=["POST"])
 def telegram_webhook():
-    update = telebot.types.Update.de_json(request.stream.read().decode("utf-8"))
-    bot.process_new_updates([update])
+    if not enqueue_update(request.stream.read().decode("utf-8")):
+        return "busy", 503
     return "ok", 200
 
+@app.route("/api/update_stats")
+def update_stats_api():
+    with _updates_lock:
+        return jsonify({"ok": True, **update_stats, "queue_depth": [q.qsize() for q in update_queues]})
+
 # === Источник данных (AniList API) ===
-ANILIST_API = "https://graphql.anilist.co"
-
-def fetch_anime_with_details():
-    query = """
-    query ($page: Int, $perPage: Int) {
-      Page(page: $page, perPage: $perPage) {
-        media(type: ANIME, sort: POPULARITY_DESC) {
-          id
-          title { romaji }
-          startDate { year }
-          genres
-          studios(isMain: true) { nodes { name } }
-          characters(perPage: 5, sort: ROLE) {
-            nodes { name { full } }
-          }
-          coverImage { extraLarge large medium color }
-          bannerImage
-        }
-      }
-    }
-    """
-    page = random.randint(1, 100)
-    resp = requests.post(ANILIST_API, json={"query": query, "variables": {"page": page, "perPage": 50}})
-    resp.raise_for_status()
-    data = resp.json()
-    return random.choice(data["data"]["Page"]["media"])
+# Клиент в anilist.py: пул соединений, token bucket под поминутную квоту,
+# Retry-After, склейка одновременных запросов страницы и короткий кеш ответов.
+ANILIST_API = os.getenv("ANILIST_API", anilist.API_URL)
+ANILIST_RATE_PER_MIN = int(os.getenv("ANILIST_RATE_PER_MIN", 80))  # лимит AniList — 90 в минуту
+ANILIST_BURST = int(os.getenv("ANILIST_BURST", 5))
+ANILIST_CACHE_TTL_SEC = int(os.getenv("ANILIST_CACHE_TTL_SEC", 60))
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Забирает токен; возвращает, сколько секунд подождать до его появления."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def full(self, now):
+        """Корзина восстановилась до capacity — от новой не отличается."""
+        with self.lock:
+            return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+anilist_client = anilist.AniListClient(
+    ANILIST_API,
+    bucket=TokenBucket(ANILIST_RATE_PER_MIN / 60, ANILIST_BURST),
+    cache_ttl=ANILIST_CACHE_TTL_SEC,
+    on_request=lambda seconds, outcome: anilist_seconds.observe(seconds, outcome),
+)
+
+def fetch_anime_page(page, per_page=50):
+    start = time.perf_counter()
+    try:
+        return anilist_client.fetch_page(page, per_page)
+    finally:
+        record_phase("anilist", time.perf_counter() - start)
+
+# === Локальный каталог аниме (SQLite) ===
+# Вопросы генерируются из локального каталога, а не из живого API:
+# фоновый поток раз в CATALOG_TTL_SEC перезабирает популярные страницы AniList.
+# Под несколькими воркерами AniList ходит только держатель flock на
+# CATALOG_DB.lock; остальные раз в CATALOG_RELOAD_SEC перечитывают общую базу.
+CATALOG_DB = os.getenv("CATALOG_DB", "catalog.sqlite3")
+CATALOG_SEED = os.getenv("CATALOG_SEED", "catalog_seed.json")
+CATALOG_TTL_SEC = int(os.getenv("CATALOG_TTL_SEC", 12 * 3600))  # 0 — не обновлять (бенчи, офлайн)
+CATALOG_RELOAD_SEC = int(os.getenv("CATALOG_RELOAD_SEC", 300))
+CATALOG_PAGES = int(os.getenv("CATALOG_PAGES", 100))
+
+catalog_media = []  # in-memory копия каталога для быстрого random.choice
+catalog_by_id = {}  # id тайтла -> запись каталога
+catalog_images = {}  # id тайтла -> URL обложки на CDN AniList
+_catalog_lock = threading.Lock()
+_catalog_db = None
+_catalog_leader_file = None  # открыт, пока этот процесс держит flock обновления
+
+def catalog_db():
+    global _catalog_db
+    if _catalog_db is None:
+        _catalog_db = sqlite3.connect(CATALOG_DB, check_same_thread=False)
+        _catalog_db.execute("CREATE TABLE IF NOT EXISTS media (id INTEGER PRIMARY KEY, page INTEGER, data TEXT NOT NULL)")
+        _catalog_db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        _catalog_db.commit()
+    return _catalog_db
+
+def catalog_store(media_list, page=None):
+    with _catalog_lock:
+        db = catalog_db()
+        if page is not None:
+            # тайтлы, которые ушли с этой страницы популярности
+            ids = [m["id"] for m in media_list]
+            db.execute(f"DELETE FROM media WHERE page = ? AND id NOT IN ({','.join('?' * len(ids))})", (page, *ids))
+        db.executemany(
+            "INSERT OR REPLACE INTO media (id, page, data) VALUES (?, ?, ?)",
+            [(m["id"], page, json.dumps(m, ensure_ascii=False)) for m in media_list]
+        )
+        db.commit()
+
+def catalog_refreshed_at():
+    with _catalog_lock:
+        row = catalog_db().execute("SELECT value FROM meta WHERE key = 'refreshed_at'").fetchone()
+    return float(row[0]) if row else 0.0
+
+def catalog_mark_refreshed(ts):
+    with _catalog_lock:
+        db = catalog_db()
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('refreshed_at', ?)", (str(ts),))
+        db.commit()
+
+def catalog_load():
+    with _catalog_lock:
+        rows = catalog_db().execute("SELECT data FROM media").fetchall()
+    global catalog_media, catalog_index, catalog_images, catalog_by_id
+    media = [json.loads(r[0]) for r in rows]
+    catalog_index = build_catalog_index(media)
+    catalog_images = {m["id"]: pick_image(m) for m in media}
+    catalog_by_id = {m["id"]: m for m in media}
+    catalog_media = media
+    return len(catalog_media)
+
+def catalog_seed_if_empty():
+    # холодный старт: пустая база + есть seed-файл -> заливаем его
+    if catalog_load() or not os.path.exists(CATALOG_SEED):
+        return
+    try:
+        with open(CATALOG_SEED, encoding="utf-8") as f:
+            seed = json.load(f)
+        catalog_store(seed)
+        print(f"🌱 Каталог засеян из {CATALOG_SEED}: {catalog_load()} тайтлов")
+    except Exception as e:
+        print(f"❌ Не удалось прочитать seed каталога: {e}")
+
+def catalog_export_seed(path=CATALOG_SEED):
+    """python app.py --export-catalog-seed [путь]: текущий каталог -> seed-файл."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(catalog_media, f, ensure_ascii=False)
+
+def catalog_prune(pages):
+    # seed и страницы за пределами CATALOG_PAGES после полного обновления не нужны
+    with _catalog_lock:
+        db = catalog_db()
+        db.execute("DELETE FROM media WHERE page IS NULL OR page > ?", (pages,))
+        db.commit()
+
+def catalog_refresh():
+    for page in range(1, CATALOG_PAGES + 1):
+        catalog_store(fetch_anime_page(page), page)  # темп задаёт token bucket клиента
+    catalog_prune(CATALOG_PAGES)
+    catalog_mark_refreshed(time.time())
+    print(f"✅ Каталог обновлён: {catalog_load()} тайтлов")
+
+def catalog_refresh_leader():
+    # лок упавшего воркера снимает ОС — обновление подхватит следующий
+    global _catalog_leader_file
+    if _catalog_leader_file is not None or fcntl is None or CATALOG_DB == ":memory:":
+        return True
+    f = open(CATALOG_DB + ".lock", "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _catalog_leader_file = f
+    return True
+
+def catalog_refresher_loop():
+    seen = catalog_refreshed_at()
+    while True:
+        try:
+            refreshed_at = catalog_refreshed_at()
+            if catalog_refresh_leader() and time.time() - refreshed_at >= CATALOG_TTL_SEC:
+                catalog_refresh()
+            elif refreshed_at != seen:
+                print(f"🔄 Каталог перечитан из базы: {catalog_load()} тайтлов")  # обновил другой воркер
+            seen = catalog_refreshed_at()
+            time.sleep(CATALOG_RELOAD_SEC)
+        except Exception as e:
+            print(f"❌ Ошибка обновления каталога: {e}")
+            time.sleep(300)
+
+def start_catalog_refresher():
+    threading.Thread(target=catalog_refresher_loop, name="catalog-refresher", daemon=True).start()
+
+def ensure_catalog():
+    """Пустой каталог (первый старт без seed) — заливаем одну живую страницу.
+    Ходит в AniList, поэтому вызывается до state_store.transaction."""
+    if catalog_media:
+        return
+    page = random.randint(1, CATALOG_PAGES)
+    catalog_store(fetch_anime_page(page), page)
+    catalog_load()
 
 def pick_image(anime):
     # приоритет: обложка extraLarge -> large -> bannerImage
     ci = anime.get("coverImage") or {}
     return ci.get("extraLarge") or ci.get("large") or anime.get("bannerImage") or None
 
-def generate_question():
-    anime = fetch_anime_with_details()
+def media_year(anime):
+    return (anime.get("startDate") or {}).get("year")
+
+def media_genres(anime):
+    return anime.get("genres") or []
+
+def media_studio(anime):
+    nodes = (anime.get("studios") or {}).get("nodes") or []
+    return nodes[0]["name"] if nodes else None
+
+def media_character(anime):
+    nodes = (anime.get("characters") or {}).get("nodes") or []
+    return nodes[0]["name"]["full"] if nodes else None
+
+# === Прокси картинок ===
+# Мини-апп грузит обложку не с CDN AniList, а с /img/<id>: каждая обложка
+# скачивается один раз, ужимается до IMAGE_MAX_WIDTH (WebP, иначе JPEG) и
+# лежит на диске. IMAGE_ORIGIN подменяет хост CDN — например, на локальный стенд.
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_ORIGIN = os.getenv("IMAGE_ORIGIN")
+IMAGE_MAX_WIDTH = int(os.getenv("IMAGE_MAX_WIDTH", 720))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 80))
+IMAGE_MAX_AGE_SEC = 30 * 24 * 3600
+IMAGE_TYPES = {".webp": "image/webp", ".jpg": "image/jpeg", ".png": "image/png", ".gif": "image/gif"}
+
+_image_locks = [threading.Lock() for _ in range(64)]  # одна закачка на обложку
+image_stats = {"hits": 0, "misses": 0, "failed": 0}
+_image_stats_lock = threading.Lock()
+
+def image_stat(key):
+    with _image_stats_lock:
+        image_stats[key] += 1
+
+def image_source_url(url):
+    if not IMAGE_ORIGIN:
+        return url
+    parts = urlsplit(url)
+    return IMAGE_ORIGIN.rstrip("/") + parts.path + (f"?{parts.query}" if parts.query else "")
+
+def image_render(raw, content_type):
+    """(bytes, расширение) копии для мини-аппа."""
+    if Image is None:
+        ext = {v: k for k, v in IMAGE_TYPES.items()}.get(content_type.split(";")[0].strip(), ".jpg")
+        return raw, ext
+    img = Image.open(io.BytesIO(raw))
+    img.thumbnail((IMAGE_MAX_WIDTH, IMAGE_MAX_WIDTH * 2))
+    out = io.BytesIO()
+    try:
+        img.save(out, "WEBP", quality=IMAGE_QUALITY, method=4)
+        return out.getvalue(), ".webp"
+    except (KeyError, OSError):  # Pillow собран без WebP
+        out = io.BytesIO()
+        img.convert("RGB").save(out, "JPEG", quality=IMAGE_QUALITY, optimize=True, progressive=True)
+        return out.getvalue(), ".jpg"
+
+def image_cached(media_id):
+    for ext in IMAGE_TYPES:
+        path = os.path.join(IMAGE_CACHE_DIR, f"{media_id}{ext}")
+        if os.path.exists(path):
+            return path
+    return None
+
+def image_path(media_id):
+    """Путь к копии обложки на диске (скачивает при первом обращении) или None."""
+    path = image_cached(media_id)
+    if path:
+        image_stat("hits")
+        return path
+    url = catalog_images.get(media_id)
+    if not url:
+        return None
+    with _image_locks[media_id % len(_image_locks)]:
+        path = image_cached(media_id)
+        if path:
+            image_stat("hits")
+            return path
+        image_stat("misses")
+        try:
+            resp = requests.get(image_source_url(url), timeout=15)
+            resp.raise_for_status()
+            body, ext = image_render(resp.content, resp.headers.get("Content-Type", ""))
+        except Exception:
+            image_stat("failed")
+            raise
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        path = os.path.join(IMAGE_CACHE_DIR, f"{media_id}{ext}")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(body)
+        os.replace(tmp, path)
+        return path
+
+def image_url(anime):
+    return f"/img/{anime['id']}" if pick_image(anime) else None
+
+@app.route("/img/<int:media_id>")
+def image_proxy(media_id):
+    try:
+        path = image_path(media_id)
+    except Exception as e:
+        print(f"❌ /img/{media_id} error: {e}")
+        return jsonify({"ok": False}), 502
+    if path is None:
+        return jsonify({"ok": False}), 404
+    return send_file(path, mimetype=IMAGE_TYPES[os.path.splitext(path)[1]],
+                     conditional=True, etag=True, max_age=IMAGE_MAX_AGE_SEC)
+
+@app.route("/api/image_stats")
+def image_stats_api():
+    with _image_stats_lock:
+        return jsonify({"ok": True, **image_stats, "pillow": Image is not None})
+
+def prefetch_image(media_id):
+    """Кладёт обложку вопроса из плана в кеш заранее; True — она на диске."""
+    try:
+        return image_path(media_id) is not None
+    except Exception as e:
+        print(f"❌ Не удалось скачать обложку {media_id}: {e}")
+        return False
+
+# === Индексы для дистракторов ===
+# Строятся один раз на каждую загрузку каталога; неправильные варианты
+# берутся из пулов значений, без дополнительных походов в API.
+catalog_index = {
+    "genre": {},      # жанр -> [id тайтлов]
+    "studio": {},     # студия -> [id тайтлов]
+    "character": {},  # главный герой -> id тайтла
+    "pools": {"genre": [], "studio": [], "character": [], "year": []},
+}
+
+def build_catalog_index(media_list):
+    by_genre, by_studio, by_character, years = {}, {}, {}, set()
+    for m in media_list:
+        for genre in media_genres(m):
+            by_genre.setdefault(genre, []).append(m["id"])
+        st = media_studio(m)
+        if st:
+            by_studio.setdefault(st, []).append(m["id"])
+        ch = media_character(m)
+        if ch:
+            by_character.setdefault(ch, m["id"])
+        if media_year(m):
+            years.add(media_year(m))
+    return {
+        "genre": by_genre,
+        "studio": by_studio,
+        "character": by_character,
+        "pools": {
+            "genre": list(by_genre),
+            "studio": list(by_studio),
+            "character": list(by_character),
+            "year": sorted(years),
+        },
+    }
+
+def pick_distractors(pool, exclude, k=3):
+    # несколько случайных проб, затем честная выборка из отфильтрованного пула —
+    # цикл всегда конечен
+    picked = []
+    for _ in range(k * 4):
+        v = random.choice(pool) if pool else None
+        if v is not None and v not in exclude and v not in picked:
+            picked.append(v)
+            if len(picked) == k:
+                return picked
+    rest = [v for v in pool if v not in exclude and v not in picked]
+    if len(rest) < k - len(picked):
+        return None
+    return picked + random.sample(rest, k - len(picked))
+
+def year_candidates(correct):
+    return [correct + d for d in range(-10, 11) if d and correct + d > 1950]
+
+def year_distractors(correct, k=3):
+    candidates = year_candidates(correct)
+    return random.sample(candidates, k) if len(candidates) >= k else None
+
+def distractors_available(keys, exclude, k=3):
+    """Есть ли среди ключей индекса k значений не из exclude — ровно тогда pick_distractors не вернёт None."""
+    return len(keys) - sum(1 for v in exclude if v in keys) >= k
+
+def question_types_for(anime, index):
+    pools = index["pools"]
+    types = []
+    if media_genres(anime) and len(set(pools["genre"]) - set(media_genres(anime))) >= 3:
+        types.append("genre")
+    if media_year(anime):
+        types.append("year")
+    if media_studio(anime) and len(pools["studio"]) > 3:
+        types.append("studio")
+    if media_character(anime) and len(pools["character"]) > 3:
+        types.append("character")
+    return types
+
+def build_question(anime, q_type, index):
     title = anime["title"]["romaji"]
-    img = pick_image(anime)
-    q_type = random.choice(["genre", "year", "studio", "character"])
-
-    if q_type == "genre" and anime.get("genres"):
-        correct = random.choice(anime["genres"])
-        wrongs = set()
-        while len(wrongs) < 3:
-            other = fetch_anime_with_details()
-            if other.get("genres"):
-                g = random.choice(other["genres"])
-                if g != correct:
-                    wrongs.add(g)
-        options = list(wrongs) + [correct]
-        random.shuffle(options)
-        return {"question": f"К какому жанру относится аниме *{title}*?",
-                "options": options, "answer": options.index(correct),
-                "correct_text": correct, "image": img}
-
-    if q_type == "year" and anime.get("startDate") and anime["startDate"].get("year"):
-        correct = anime["startDate"]["year"]
-        options = {correct}
-        while len(options) < 4:
-            fake = correct + random.randint(-10, 10)
-            if fake > 1950:
-                options.add(fake)
-        options = list(options)
-        random.shuffle(options)
-        return {"question": f"В каком году вышло аниме *{title}*?",
-                "options": [str(x) for x in options], "answer": options.index(correct),
-                "correct_text": str(correct), "image": img}
-
-    if q_type == "studio" and anime.get("studios") and anime["studios"].get("nodes"):
-        correct = anime["studios"]["nodes"][0]["name"]
-        wrongs = set()
-        while len(wrongs) < 3:
-            other = fetch_anime_with_details()
-            if other.get("studios") and other["studios"].get("nodes"):
-                st = other["studios"]["nodes"][0]["name"]
-                if st != correct:
-                    wrongs.add(st)
-        options = list(wrongs) + [correct]
-        random.shuffle(options)
-        return {"question": f"Какая студия выпустила аниме *{title}*?",
-                "options": options, "answer": options.index(correct),
-                "correct_text": correct, "image": img}
-
-    if q_type == "character" and anime.get("characters") and anime["characters"].get("nodes"):
-        correct = anime["characters"]["nodes"][0]["name"]["full"]
-        wrongs = set()
-        while len(wrongs) < 3:
-            other = fetch_anime_with_details()
-            if other.get("characters") and other["characters"].get("nodes"):
-                ch = other["characters"]["nodes"][0]["name"]["full"]
-                if ch != correct:
-                    wrongs.add(ch)
-        options = list(wrongs) + [correct]
-        random.shuffle(options)
-        return {"question": f"Кто главный герой в аниме *{title}*?",
-                "options": options, "answer": options.index(correct),
-                "correct_text": correct, "image": img}
-
-    return generate_question()
+    img = image_url(anime)
+    pools = index["pools"]
+
+    if q_type == "genre":
+        correct = random.choice(media_genres(anime))
+        wrongs = pick_distractors(pools["genre"], set(media_genres(anime)))
+        text = f"К какому жанру относится аниме *{title}*?"
+    elif q_type == "year":
+        correct = media_year(anime)
+        wrongs = year_distractors(correct)
+        text = f"В каком году вышло аниме *{title}*?"
+    elif q_type == "studio":
+        correct = media_studio(anime)
+        wrongs = pick_distractors(pools["studio"], {correct})
+        text = f"Какая студия выпустила аниме *{title}*?"
+    else:
+        correct = media_character(anime)
+        # не берём других героев того же тайтла
+        same_title = {n["name"]["full"] for n in anime["characters"]["nodes"]}
+        wrongs = pick_distractors(pools["character"], {correct} | same_title)
+        text = f"Кто главный герой в аниме *{title}*?"
+
+    if not wrongs:
+        return None
+    options = [str(x) for x in wrongs] + [str(correct)]
+    random.shuffle(options)
+    return {"question": text, "options": options, "answer": options.index(str(correct)),
+            "correct_text": str(correct), "image": img, "media_id": anime["id"]}
+
+def can_build(anime, q_type, index):
+    """Соберёт ли build_question вопрос этого типа — те же проверки пулов,
+    но без случайного выбора и метрик (для планирования)."""
+    if q_type == "genre":
+        genres = set(media_genres(anime))
+        return bool(genres) and distractors_available(index["genre"], genres)
+    if q_type == "year":
+        correct = media_year(anime)
+        return bool(correct) and len(year_candidates(correct)) >= 3
+    correct = media_studio(anime) if q_type == "studio" else media_character(anime)
+    if not correct:
+        return False
+    if q_type == "studio":
+        return distractors_available(index["studio"], {correct})
+    same_title = {n["name"]["full"] for n in anime["characters"]["nodes"]}
+    return distractors_available(index["character"], {correct} | same_title)
+
+QUESTION_TYPES = ("genre", "year", "studio", "character")
+QUESTION_SUBJECT_ATTEMPTS = 20
+
+def make_question(anime, types, index):
+    """Вопрос первого из types, для которого нашлись дистракторы: (тип, вопрос) или (None, None)."""
+    for q_type in types:
+        start = time.perf_counter()
+        q = build_question(anime, q_type, index)
+        question_seconds.observe(time.perf_counter() - start, q_type)
+        question_attempts.inc(q_type, "ok" if q else "no_distractors")
+        if q:
+            return q_type, q
+    return None, None
+
+def generate_question(exclude_ids=()):
+    if not catalog_media:
+        raise RuntimeError("каталог пуст")
+    for _ in range(QUESTION_SUBJECT_ATTEMPTS):
+        anime = random.choice(catalog_media)
+        if anime["id"] in exclude_ids:
+            continue
+        index = catalog_index
+        types = question_types_for(anime, index)
+        if not types:
+            question_attempts.inc("none", "no_types")
+            continue
+        _, q = make_question(anime, [random.choice(types)], index)
+        if q:
+            return q
+    raise RuntimeError("не удалось сгенерировать вопрос из каталога")
+
+# === План квиза ===
+# Вопросы на всю игру выбираются одним проходом по каталогу, как только
+# известно число раундов (/api/admin/config или старт первого раунда).
+# План — пары [media_id, тип] в gs.plan, сыгранные тайтлы — в gs.used_media:
+# оба в ChatState, поэтому переживают рестарт и видны всем воркерам.
+# Раунд берёт следующую пару и собирает вопрос (дистракторы) в этот момент;
+# обложки ближайших PREFETCH_DEPTH тайтлов пул воркеров заранее кладёт в кеш /img.
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", 3))
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 4))
+
+def plan_quiz(count, exclude_ids=()):
+    """count пар [media_id, тип] за один проход по каталогу: тайтлы не
+    повторяются (и не берутся из exclude_ids), типы вопросов — поровну,
+    насколько позволяет каталог."""
+    media, index = catalog_media, catalog_index
+    quota = -(-count // len(QUESTION_TYPES))
+    type_counts = dict.fromkeys(QUESTION_TYPES, 0)
+    planned, used, leftovers = [], set(exclude_ids), []
+
+    def add(anime, types):
+        # сначала самый недобранный тип, среди равных — случайный
+        order = sorted(types, key=lambda t: (type_counts[t], random.random()))
+        # сам вопрос соберёт take_question — здесь только проверка, что дистракторы есть
+        q_type = next((t for t in order if can_build(anime, t, index)), None)
+        if q_type:
+            type_counts[q_type] += 1
+            used.add(anime["id"])
+            planned.append([anime["id"], q_type])
+
+    for i in random.sample(range(len(media)), min(len(media), count * QUESTION_SUBJECT_ATTEMPTS)):
+        if len(planned) == count:
+            break
+        anime = media[i]
+        if anime["id"] in used:
+            continue
+        types = question_types_for(anime, index)
+        if not types:
+            question_attempts.inc("none", "no_types")
+            continue
+        open_types = [t for t in types if type_counts[t] < quota]
+        if open_types:
+            add(anime, open_types)
+        else:
+            leftovers.append((anime, types))
+    # квоту добрать не вышло — берём отложенных тайтлов с любым типом
+    for anime, types in leftovers:
+        if len(planned) == count:
+            break
+        add(anime, types)
+    random.shuffle(planned)
+    return planned
+
+prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+cover_prefetch = {}  # chat_id -> {media_id: Future}; у каждого воркера свой
+prefetch_stats = {"hits": 0, "misses": 0}
+_prefetch_lock = threading.Lock()
+plan_seconds = Histogram("quiz_plan_seconds", "Сборка плана вопросов на игру")
+
+def prefetch_covers(gs):
+    with _prefetch_lock:
+        covers = cover_prefetch.setdefault(gs.chat_id, {})
+        for media_id, _ in gs.plan[:PREFETCH_DEPTH]:
+            if media_id not in covers and catalog_images.get(media_id):
+                covers[media_id] = prefetch_pool.submit(prefetch_image, media_id)
+
+def plan_questions(gs, remaining):
+    """Добирает gs.plan до remaining вопросов одним батчем. Под
+    state_store.transaction; каталог уже залит (ensure_catalog)."""
+    missing = remaining - len(gs.plan)
+    if missing > 0:
+        start = time.perf_counter()
+        try:
+            batch = plan_quiz(missing, set(gs.used_media).union(mid for mid, _ in gs.plan))
+        except Exception as e:
+            print(f"❌ Не удалось собрать план вопросов: {e}")
+            batch = []
+        elapsed = time.perf_counter() - start
+        plan_seconds.observe(elapsed)
+        record_phase("question", elapsed)
+        gs.plan.extend(batch)
+    prefetch_covers(gs)
+
+def planned_question(media_id, q_type):
+    anime = catalog_by_id.get(media_id)
+    if anime is None:
+        return None  # тайтл выпал из каталога при обновлении
+    types = [q_type] + [t for t in question_types_for(anime, catalog_index) if t != q_type]
+    return make_question(anime, types, catalog_index)[1]
+
+def take_question(gs):
+    """Вопрос следующего раунда из плана; план пуст — случайный тайтл не из сыгранных."""
+    start = time.perf_counter()
+    try:
+        q = None
+        while gs.plan and q is None:
+            q = planned_question(*gs.plan.pop(0))
+        with _prefetch_lock:
+            cover = cover_prefetch.get(gs.chat_id, {}).pop(q["media_id"], None) if q else None
+        if q is None:
+            hit = False
+            q = generate_question(set(gs.used_media))
+        elif cover is not None:
+            hit = not q["image"] or (cover.done() and cover.result())  # неудачная закачка — промах
+        else:
+            hit = not q["image"] or image_cached(q["media_id"]) is not None  # мог скачать другой воркер
+        with _prefetch_lock:
+            prefetch_stats["hits" if hit else "misses"] += 1
+        gs.used_media.append(q["media_id"])
+        prefetch_covers(gs)
+        return q
+    finally:
+        record_phase("question", time.perf_counter() - start)
+
+def drop_covers(chat_id):
+    with _prefetch_lock:
+        for fut in cover_prefetch.pop(chat_id, {}).values():
+            fut.cancel()
+
+def remaining_rounds(gs):
+    return max(0, gs.rounds_total - gs.rounds_played)
+
+# === Исходящие сообщения Telegram ===
+# Рассылки из хендлеров уходят в очередь: ограниченный пул воркеров,
+# token bucket на глобальный лимит и на каждый чат, повтор по 429 retry_after.
+TG_SEND_WORKERS = int(os.getenv("TG_SEND_WORKERS", 4))
+TG_GLOBAL_RATE = 30.0   # сообщений в секунду на бота
+TG_CHAT_RATE = 1.0      # сообщений в секунду в один чат
+TG_MAX_RETRIES = 3
+TG_BUCKET_SWEEP_SEC = 60  # как часто выбрасывать корзины чатов, простоявшие до полной
+
+class TelegramDispatcher:
+    def __init__(self, workers, global_rate, chat_rate):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self._swept_at = time.monotonic()
+        self.stats = {"queued": 0, "sent": 0, "failed": 0, "retried": 0}
+        self._heap = []  # (ready_at, seq, job)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"tg-send-{i}", daemon=True).start()
+
+    def submit(self, chat_id, fn, *args, on_ok=None, on_error=None, delay=0.0, **kwargs):
+        job = {"chat_id": chat_id, "fn": fn, "args": args, "kwargs": kwargs,
+               "on_ok": on_ok, "on_error": on_error, "attempt": 0}
+        self._push(job, time.monotonic() + delay)
+
+    def send_message(self, chat_id, text, on_ok=None, on_error=None, **kwargs):
+        self.submit(chat_id, bot.send_message, chat_id, text, on_ok=on_ok, on_error=on_error, **kwargs)
+
+    def depth(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _push(self, job, ready_at):
+        with self._cond:
+            heapq.heappush(self._heap, (ready_at, next(self._seq), job))
+            self.stats["queued"] += 1
+            self._cond.notify()
+
+    def _pop(self):
+        with self._cond:
+            while True:
+                if self._heap:
+                    ready_at = self._heap[0][0]
+                    now = time.monotonic()
+                    if ready_at <= now:
+                        return heapq.heappop(self._heap)[2]
+                    self._cond.wait(ready_at - now)
+                else:
+                    self._cond.wait()
+
+    def _reserve_chat(self, chat_id):
+        # резерв под тем же локом, что и чистка: корзину не выбросят между get и reserve
+        with self._cond:
+            now = time.monotonic()
+            if now - self._swept_at >= TG_BUCKET_SWEEP_SEC:
+                self._swept_at = now
+                for cid in [cid for cid, b in self.chat_buckets.items() if b.full(now)]:
+                    del self.chat_buckets[cid]
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+            return bucket.reserve()
+
+    def _worker(self):
+        while True:
+            job = self._pop()
+            # лимит на чат не держит воркер: токен уже зарезервирован,
+            # задача просто возвращается в очередь до нужного момента
+            if not job.pop("reserved", False):
+                wait = self._reserve_chat(job["chat_id"])
+                if wait > 0:
+                    job["reserved"] = True
+                    self._push(job, time.monotonic() + wait)
+                    continue
+            time.sleep(self.global_bucket.reserve())
+            try:
+                job["fn"](*job["args"], **job["kwargs"])
+            except Exception as e:
+                retry_after = telegram_retry_after(e)
+                if retry_after is not None and job["attempt"] < TG_MAX_RETRIES:
+                    job["attempt"] += 1
+                    self._count("retried")
+                    self._push(job, time.monotonic() + retry_after)
+                    continue
+                self._count("failed")
+                self._callback(job["on_error"], e)
+                continue
+            self._count("sent")
+            self._callback(job["on_ok"])
+
+    def _count(self, key):
+        # stats общие для всех воркеров — считаем под тем же локом, что и queued
+        with self._cond:
+            self.stats[key] += 1
+
+    @staticmethod
+    def _callback(cb, *args):
+        if cb is None:
+            return
+        try:
+            cb(*args)
+        except Exception as e:
+            print(f"❌ Ошибка в колбэке рассылки: {e}")
+
+def telegram_retry_after(exc):
+    if isinstance(exc, telebot.apihelper.ApiTelegramException) and exc.error_code == 429:
+        return float((exc.result_json.get("parameters") or {}).get("retry_after", 1))
+    return None
+
+tg_dispatcher = TelegramDispatcher(TG_SEND_WORKERS, TG_GLOBAL_RATE, TG_CHAT_RATE)
+
+# Все вызовы Bot API (и из хендлеров, и из рассыльщика) проходят через
+# apihelper._make_request — там их и меряем, с именем метода в метке.
+_tg_make_request = telebot.apihelper._make_request
+
+def timed_telegram_request(token, method_name, *args, **kwargs):
+    with timed(telegram_seconds, "telegram", method_name):
+        return _tg_make_request(token, method_name, *args, **kwargs)
+
+telebot.apihelper._make_request = timed_telegram_request
+
+_bot_username = None
+
+def bot_username():
+    global _bot_username
+    if _bot_username is None:
+        _bot_username = bot.get_me().username
+    return _bot_username
+
+# === Объявления в группе ===
+# «✅ X в игре» и «⚠️ X, открой ЛС» копятся ANNOUNCE_WINDOW_SEC и уходят одним
+# сообщением: в группу Telegram пускает ~20 сообщений в минуту, а набор на
+# 40 человек — это десятки объявлений. /quiz сбрасывает буфер сразу, чтобы
+# состав ушёл в чат раньше объявления о старте.
+ANNOUNCE_WINDOW_SEC = float(os.getenv("ANNOUNCE_WINDOW_SEC", 3.0))
+
+class Announcer:
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}  # chat_id -> [(вид, имя, текст отдельного сообщения)]
+        self.stats = {"events": 0, "messages": 0, "saved": 0}
+        self._lock = threading.Lock()
+
+    def add(self, chat_id, kind, name, text):
+        with self._lock:
+            events = self.pending.setdefault(chat_id, [])
+            events.append((kind, name, text))
+            self.stats["events"] += 1
+            first = len(events) == 1
+        if first:
+            tg_dispatcher.submit(chat_id, self._send_pending, chat_id, [], delay=self.window)
+
+    def take(self, chat_id):
+        with self._lock:
+            events = self.pending.pop(chat_id, None)
+            if events:
+                self.stats["messages"] += 1
+                self.stats["saved"] += len(events) - 1
+        return events
+
+    def flush(self, chat_id):
+        """Отправить накопленное сейчас, в потоке вызывающего."""
+        events = self.take(chat_id)
+        if events:
+            try:
+                bot.send_message(chat_id, announcement_text(chat_id, events))
+            except Exception as e:
+                print(f"❌ Не удалось отправить объявление в {chat_id}: {e}")
+
+    def _send_pending(self, chat_id, sent_text):
+        # первый запуск забирает буфер; повтор по 429 шлёт тот же текст
+        if not sent_text:
+            events = self.take(chat_id)
+            if not events:
+                return  # уже сброшено из /quiz
+            sent_text.append(announcement_text(chat_id, events))
+        bot.send_message(chat_id, sent_text[0])
+
+def announcement_text(chat_id, events):
+    if len(events) == 1:
+        return events[0][2]
+    by_kind = {}
+    for kind, name, text in events:
+        by_kind.setdefault(kind, []).append((name, text))
+    lines = []
+    for kind, items in by_kind.items():
+        names = ", ".join(name for name, _ in items)
+        if len(items) == 1:
+            lines.append(items[0][1])
+        elif kind == "joined":
+            lines.append(f"✅ В игре: {names}")
+        else:
+            link_deep = deep_link(bot_username(), chat_id)
+            link_plain = f"https://t.me/{bot_username()}"
+            lines.append(f"⚠️ {names} — откройте ЛС с ботом: {link_deep} (или {link_plain}) и нажмите Start.")
+    return "\n".join(lines)
+
+announcer = Announcer(ANNOUNCE_WINDOW_SEC)
 
 # === Состояние игры ===
-game_states = {}
-# game_states[chat_id] = {
-#   players: { uid: { name, answered, dm_ok, total_time, last_answer_time } },
-#   scores: { uid: int },
-#   admin_id: int|None,
-#   quiz_started: bool,
-#   locked: bool,
-#   timer_seconds: int|None,
-#   rounds_total: int,
-#   rounds_played: int,
-#   round: { q, started_at, deadline, finished } | None,
-#   rev: int
-# }
-
-# Отдельно — состояние «рематча»
-# chat_id: { admin_id: int, confirmed: {uid: name}, leaderboard: [...], created_at: float }
-rematch_states = {}
+# Компактные модели со __slots__: у объектов нет __dict__, очки хранятся прямо
+# в Player. Наружу состояние уходит только явно: в API — через *_payload(),
+# в хранилище — через to_dict()/from_dict().
+@dataclass(slots=True)
+class Player:
+    name: str
+    dm_ok: bool = True
+    score: int = 0
+    epoch: int = 0                # эпоха раунда, в котором игрок ответил последним
+    answer_time: float = 0.0      # сумма времени ответов
+    timeout_skip: float = 0.0     # длительность раундов, где игрок ответил
+    last_answer_time: float | None = None
+
+@dataclass(slots=True)
+class Round:
+    q: dict
+    started_at: float
+    deadline: float
+    duration: int
+    epoch: int
+    answered: int = 0
+    finished: bool = False
+
+@dataclass(slots=True)
+class ChatState:
+    chat_id: int
+    game_id: str = field(default_factory=lambda: os.urandom(4).hex())  # отличает ETag'и новой игры в том же чате
+    players: dict = field(default_factory=dict)  # uid -> Player
+    admin_id: int | None = None
+    quiz_started: bool = False
+    locked: bool = False
+    timer_seconds: int | None = None
+    rounds_total: int = 10        # по умолчанию
+    rounds_played: int = 0
+    round: Round | None = None
+    epoch: int = 0                # растёт с каждым раундом; игрок ответил, если p.epoch == round.epoch
+    timeout_total: float = 0.0    # сумма длительностей всех начатых раундов
+    rev: int = 0
+    touched_at: float = field(default_factory=time.time)  # последнее изменение, для очистки брошенных игр
+    plan: list = field(default_factory=list)        # [[media_id, тип вопроса]] следующих раундов
+    used_media: list = field(default_factory=list)  # тайтлы уже заданных вопросов
+
+    def to_dict(self):
+        data = asdict(self)
+        data["players"] = {str(uid): p for uid, p in data["players"].items()}
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        scores = data.pop("scores", {})  # записи до перехода на модели: очки отдельно
+        data["players"] = {int(uid): Player(**{"score": scores.get(uid, 0), **p}) for uid, p in data["players"].items()}
+        if data["round"] is not None:
+            data["round"] = Round(**data["round"])
+        return cls(**data)
+
+# Отдельно — состояние «рематча»; меняя его, обновляйте touched_at (по нему журнал видит изменение)
+@dataclass(slots=True)
+class RematchState:
+    admin_id: int
+    leaderboard: list             # [{user_id, name, score, total_time}]
+    confirmed: dict = field(default_factory=dict)  # str(uid) -> name
+    created_at: float = field(default_factory=time.time)
+    touched_at: float = field(default_factory=time.time)
+
+    def to_dict(self):
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+game_states = {}     # chat_id -> ChatState
+rematch_states = {}  # chat_id -> RematchState
+
+# Блокировки по чатам (lock striping): любое чтение-изменение-запись состояния
+# чата — game_states, rematch_states, кеш ответа — под chat_lock(chat_id)
+# (через state_store.transaction, см. ниже).
+# Разные чаты почти всегда попадают в разные полосы и идут параллельно.
+CHAT_LOCK_STRIPES = 256
+_chat_locks = [threading.RLock() for _ in range(CHAT_LOCK_STRIPES)]
+
+def chat_lock(chat_id):
+    return _chat_locks[hash(chat_id) % CHAT_LOCK_STRIPES]
+
+@contextlib.contextmanager
+def timed_lock(lock):
+    start = time.perf_counter()
+    with lock:
+        waited = time.perf_counter() - start
+        lock_wait_seconds.observe(waited)
+        record_phase("lock", waited)
+        yield
 
 def ensure_chat_state(chat_id):
     if chat_id not in game_states:
-        game_states[chat_id] = {
-            "players": {},
-            "scores": {},
-            "admin_id": None,
-            "quiz_started": False,
-            "locked": False,
-            "timer_seconds": None,
-            "rounds_total": 10,   # по умолчанию
-            "rounds_played": 0,
-            "round": None,
-            "rev": 0
-        }
+        game_states[chat_id] = ChatState(chat_id)
     return game_states[chat_id]
 
-def bump_rev(gs):
-    gs["rev"] = gs.get("rev", 0) + 1
+# === Хранилище состояния ===
+# Обработчики работают с game_states/rematch_states внутри
+# state_store.transaction(chat_id). В памяти это просто chat_lock; SQLite-бэкенд
+# делает из словарей кеш процесса: на входе подтягивает актуальное состояние
+# чата из базы, на выходе записывает изменения, всё в одной транзакции —
+# так несколько воркеров gunicorn могут обслуживать одни и те же чаты.
+# Обработчики, которые только читают, берут state_store.reading(chat_id):
+# в SQLite это отложенная транзакция без очереди писателей (см. reading_state).
+class MemoryStateStore:
+    rev_poll_sec = None  # rev меняется только в этом процессе — хватает notify
+
+    def transaction(self, chat_id):
+        return timed_lock(chat_lock(chat_id))
+
+    def reading(self, chat_id):
+        return timed_lock(chat_lock(chat_id))
+
+    def peek(self, chat_id):
+        """Текущий rev чата или None, если игры нет."""
+        gs = game_states.get(chat_id)
+        return gs.rev if gs else None
+
+    def idle_games(self, cutoff):
+        """Чаты с игрой, не тронутой с cutoff."""
+        return [chat_id for chat_id, gs in list(game_states.items()) if gs.touched_at <= cutoff]
+
+    def idle_rematches(self, cutoff):
+        return [chat_id for chat_id, rs in list(rematch_states.items()) if rs.touched_at <= cutoff]
+
+    def oldest_games(self, limit):
+        """Игры сверх limit, начиная с давно не тронутых (LRU)."""
+        excess = len(game_states) - limit
+        if excess <= 0:
+            return []
+        return [chat_id for chat_id, _ in heapq.nsmallest(excess, list(game_states.items()), key=lambda kv: kv[1].touched_at)]
+
+def encode_game_state(gs):
+    return json.dumps(gs.to_dict(), ensure_ascii=False)
+
+def decode_game_state(raw):
+    return ChatState.from_dict(json.loads(raw))
+
+class SQLiteStateStore:
+    rev_poll_sec = 0.25  # изменения из других процессов long-poll видит с этой задержкой
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        # писатель в SQLite всё равно один; ждём очереди на своём локе, а не в
+        # busy-таймауте sqlite — под gevent тот спит, не отдавая управление
+        self._write_lock = threading.Lock()
+        db = self._db()
+        db.execute("CREATE TABLE IF NOT EXISTS games (chat_id INTEGER PRIMARY KEY, game_id TEXT, rev INTEGER, data TEXT NOT NULL, touched_at REAL)")
+        db.execute("CREATE TABLE IF NOT EXISTS rematches (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, touched_at REAL)")
+        # touched_at отдельной колонкой — чтобы очистка находила брошенные чаты
+        # в базе, а не только в кеше своего процесса; старые базы дополняем из data
+        for table in ("games", "rematches"):
+            if "touched_at" not in {row[1] for row in db.execute(f"PRAGMA table_info({table})")}:
+                db.execute(f"ALTER TABLE {table} ADD COLUMN touched_at REAL")
+                db.execute(f"UPDATE {table} SET touched_at = json_extract(data, '$.touched_at')")
+            db.execute(f"CREATE INDEX IF NOT EXISTS {table}_touched_at ON {table} (touched_at)")
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self, chat_id):
+        with timed_lock(chat_lock(chat_id)):
+            db = self._db()
+            outer = getattr(self._local, "chats", None)
+            if outer is not None:
+                # вложенный вызов в том же потоке: присоединяемся к открытой транзакции
+                if chat_id in outer:
+                    yield
+                    return
+                outer.add(chat_id)
+                try:
+                    before = self._load(db, chat_id)
+                    yield
+                    self._save(db, chat_id, before)
+                finally:
+                    outer.discard(chat_id)
+                return
+            start = time.perf_counter()
+            if not self._write_lock.acquire(timeout=10):
+                raise sqlite3.OperationalError("database is locked")
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                record_phase("db_lock", time.perf_counter() - start)
+                self._local.chats = {chat_id}
+                try:
+                    before = self._load(db, chat_id)
+                    yield
+                    self._save(db, chat_id, before)
+                    db.execute("COMMIT")
+                except BaseException:
+                    db.execute("ROLLBACK")
+                    game_states.pop(chat_id, None)  # кеш мог разойтись с базой
+                    rematch_states.pop(chat_id, None)
+                    raise
+                finally:
+                    self._local.chats = None
+            finally:
+                self._write_lock.release()
+
+    @contextlib.contextmanager
+    def reading(self, chat_id):
+        # BEGIN без IMMEDIATE: в WAL читатели не ждут писателя и друг друга
+        with timed_lock(chat_lock(chat_id)):
+            db = self._db()
+            outer = getattr(self._local, "chats", None)
+            if outer is not None and chat_id in outer:
+                yield
+                return
+            own = not db.in_transaction
+            if own:
+                db.execute("BEGIN")
+            try:
+                game_before, _ = self._load(db, chat_id)
+                yield
+            finally:
+                if own:
+                    db.execute("COMMIT")
+            gs = game_states.get(chat_id)
+            if ((gs.game_id, gs.rev) if gs else None) != game_before:
+                game_states.pop(chat_id, None)  # в базу это не попало — кеш перечитается
+                raise RuntimeError(f"Изменение игры {chat_id} внутри reading()")
+
+    def _load(self, db, chat_id):
+        row = db.execute("SELECT game_id, rev, data FROM games WHERE chat_id = ?", (chat_id,)).fetchone()
+        cached = game_states.get(chat_id)
+        if row is None:
+            game_states.pop(chat_id, None)
+        elif not cached or (cached.game_id, cached.rev) != (row[0], row[1]):
+            game_states[chat_id] = decode_game_state(row[2])
+        rrow = db.execute("SELECT data FROM rematches WHERE chat_id = ?", (chat_id,)).fetchone()
+        if rrow is None:
+            rematch_states.pop(chat_id, None)
+        else:
+            rematch_states[chat_id] = RematchState.from_dict(json.loads(rrow[0]))
+        gs = game_states.get(chat_id)
+        return (gs.game_id, gs.rev) if gs else None, rrow[0] if rrow else None
+
+    def _save(self, db, chat_id, before):
+        game_before, rematch_before = before
+        gs = game_states.get(chat_id)
+        if gs is None:
+            if game_before is not None:
+                db.execute("DELETE FROM games WHERE chat_id = ?", (chat_id,))
+        elif (gs.game_id, gs.rev) != game_before:
+            db.execute("INSERT OR REPLACE INTO games (chat_id, game_id, rev, data, touched_at) VALUES (?, ?, ?, ?, ?)",
+                       (chat_id, gs.game_id, gs.rev, encode_game_state(gs), gs.touched_at))
+        rs = rematch_states.get(chat_id)
+        if rs is None:
+            if rematch_before is not None:
+                db.execute("DELETE FROM rematches WHERE chat_id = ?", (chat_id,))
+        else:
+            raw = json.dumps(rs.to_dict(), ensure_ascii=False)
+            if raw != rematch_before:
+                db.execute("INSERT OR REPLACE INTO rematches (chat_id, data, touched_at) VALUES (?, ?, ?)",
+                           (chat_id, raw, rs.touched_at))
+
+    def peek(self, chat_id):
+        row = self._db().execute("SELECT rev FROM games WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def idle_games(self, cutoff):
+        return [row[0] for row in self._db().execute("SELECT chat_id FROM games WHERE touched_at <= ?", (cutoff,))]
+
+    def idle_rematches(self, cutoff):
+        return [row[0] for row in self._db().execute("SELECT chat_id FROM rematches WHERE touched_at <= ?", (cutoff,))]
+
+    def oldest_games(self, limit):
+        # лимит общий на базу: кеш процесса видит только свои чаты
+        db = self._db()
+        excess = db.execute("SELECT COUNT(*) FROM games").fetchone()[0] - limit
+        if excess <= 0:
+            return []
+        return [row[0] for row in db.execute("SELECT chat_id FROM games ORDER BY touched_at LIMIT ?", (excess,))]
+
+# Журнал: состояние живёт в памяти, как у MemoryStateStore, а каждая
+# транзакция, поменявшая игру или рематч, дописывает строку в журнал —
+# патч с изменившимися полями, игроками и раундом (по rev_events), целую
+# игру, если патч не собрать, или удаление. Поток журнала раз в
+# JOURNAL_FLUSH_SEC пишет накопленное одним write + fsync, поэтому запрос
+# fsync не ждёт (при падении теряется не больше этого окна). Раз в
+# JOURNAL_SNAPSHOT_SEC журнал переключается на новый сегмент и пишется
+# снимок всех игр; старые сегменты удаляются. На старте: снимок + хвост.
+# Один процесс: несколько воркеров с общим состоянием — это SQLite.
+JOURNAL_FLUSH_SEC = float(os.getenv("JOURNAL_FLUSH_SEC", 0.1))
+JOURNAL_SNAPSHOT_SEC = int(os.getenv("JOURNAL_SNAPSHOT_SEC", 60))
+JOURNAL_SNAPSHOT_RECORDS = int(os.getenv("JOURNAL_SNAPSHOT_RECORDS", 20000))
+JOURNAL_SEGMENT = re.compile(r'journal\.(\d+)\.log')
+
+PLAN_FIELDS = ("plan", "used_media")  # в патч — только когда менялся план, см. bump_rev(gs, {"plan": True})
+GAME_SCALAR_FIELDS = tuple(f.name for f in fields(ChatState) if f.name not in ("chat_id", "players", "round") + PLAN_FIELDS)
+ROUND_SCALAR_FIELDS = tuple(f.name for f in fields(Round) if f.name != "q")
+
+def journal_game_record(gs, game_before, rev_before):
+    """Патч игры от rev_before до gs.rev или вся игра, если изменения не восстановить из rev_events."""
+    if game_before != gs.game_id:
+        # новая игра (в т.ч. созданная без bump_rev) — патчу не к чему примениться при восстановлении
+        return {"c": gs.chat_id, "g": gs.to_dict()}
+    changes = []
+    log = rev_events.get(gs.chat_id)
+    if log and log[0] == gs.game_id:
+        for rev, ch in reversed(log[1]):
+            if rev <= rev_before:
+                break
+            changes.append(ch)
+    if len(changes) != gs.rev - rev_before or any(ch is None for ch in changes):
+        return {"c": gs.chat_id, "g": gs.to_dict()}
+    uids = {uid for ch in changes for uid in ch.get("players", ())}
+    patch = {key: getattr(gs, key) for key in GAME_SCALAR_FIELDS}
+    patch["players"] = {str(uid): asdict(gs.players[uid]) for uid in uids if uid in gs.players}
+    patch["gone"] = [uid for uid in uids if uid not in gs.players]
+    if any(ch.get("plan") or ch.get("round") for ch in changes):
+        for key in PLAN_FIELDS:
+            patch[key] = getattr(gs, key)
+    rnd = gs.round
+    if rnd is None:
+        patch["round"] = None
+    elif any(ch.get("round") for ch in changes):
+        patch["round"] = asdict(rnd)
+    else:
+        patch["round"] = {key: getattr(rnd, key) for key in ROUND_SCALAR_FIELDS}  # вопрос тот же
+    return {"c": gs.chat_id, "p": patch}
+
+def journal_apply(rec):
+    chat_id = rec["c"]
+    if "g" in rec:
+        game_states[chat_id] = ChatState.from_dict(rec["g"])
+    elif "p" in rec:
+        patch = rec["p"]
+        gs = game_states.get(chat_id)
+        if gs is None or gs.game_id != patch["game_id"] or patch["rev"] <= gs.rev:
+            return  # уже в снимке
+        for key in GAME_SCALAR_FIELDS:
+            setattr(gs, key, patch[key])
+        for key in PLAN_FIELDS:
+            if key in patch:
+                setattr(gs, key, patch[key])
+        for uid, p in patch["players"].items():
+            gs.players[int(uid)] = Player(**p)
+        for uid in patch["gone"]:
+            gs.players.pop(uid, None)
+        rnd = patch["round"]
+        if rnd is None or "q" in rnd:
+            gs.round = Round(**rnd) if rnd else None
+        elif gs.round:
+            for key, value in rnd.items():
+                setattr(gs.round, key, value)
+    elif "del" in rec:
+        gs = game_states.get(chat_id)
+        if gs and gs.game_id == rec["del"]:
+            del game_states[chat_id]
+    elif rec.get("r") is None:
+        rematch_states.pop(chat_id, None)
+    else:
+        rematch_states[chat_id] = RematchState.from_dict(rec["r"])
+
+def rematch_version(rs):
+    # любое изменение рематча обновляет touched_at, новый рематч — новый объект
+    return (id(rs), rs.touched_at) if rs else None
+
+class JournalStateStore(MemoryStateStore):
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.stats = {"records": 0, "bytes": 0, "fsyncs": 0, "snapshots": 0}
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._segment = 0
+        self._file = None
+        self._since_snapshot = 0
+        self._snapshot_at = time.time()
+
+    @contextlib.contextmanager
+    def transaction(self, chat_id):
+        with timed_lock(chat_lock(chat_id)):
+            gs = game_states.get(chat_id)
+            rs = rematch_states.get(chat_id)
+            game_before = (gs.game_id, gs.rev) if gs else (None, 0)
+            rematch_before = rematch_version(rs)
+            try:
+                yield
+            finally:
+                self._record(chat_id, game_before, rematch_before)
+
+    def _record(self, chat_id, game_before, rematch_before):
+        records = []
+        gs = game_states.get(chat_id)
+        if gs is None:
+            if game_before[0] is not None:
+                records.append({"c": chat_id, "del": game_before[0]})
+        elif (gs.game_id, gs.rev) != game_before:
+            records.append(journal_game_record(gs, *game_before))
+        rs = rematch_states.get(chat_id)
+        if rematch_version(rs) != rematch_before:
+            records.append({"c": chat_id, "r": rs.to_dict() if rs else None})
+        if records:
+            lines = [json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in records]
+            with self._lock:
+                self._buffer.extend(lines)
+
+    def _segment_path(self, n):
+        return os.path.join(self.path, f"journal.{n}.log")
+
+    def _segments(self):
+        found = (JOURNAL_SEGMENT.fullmatch(name) for name in os.listdir(self.path))
+        return sorted(int(m.group(1)) for m in found if m)
+
+    def restore(self):
+        """Снимок + хвост журнала -> game_states/rematch_states; потом журнал пишется дальше."""
+        start = time.perf_counter()
+        first = 0
+        snap_path = os.path.join(self.path, "snapshot.json")
+        if os.path.exists(snap_path):
+            with open(snap_path, encoding="utf-8") as f:
+                snap = json.load(f)
+            first = snap["segment"]
+            for data in snap["games"]:
+                game_states[data["chat_id"]] = ChatState.from_dict(data)
+            for chat_id, data in snap["rematches"].items():
+                rematch_states[int(chat_id)] = RematchState.from_dict(data)
+        replayed = 0
+        segments = [n for n in self._segments() if n >= first]
+        for n in segments:
+            with open(self._segment_path(n), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        break  # недописанная строка при падении — дальше в сегменте ничего нет
+                    journal_apply(rec)
+                    replayed += 1
+        for chat_id, gs in game_states.items():
+            if gs.round and not gs.round.finished:
+                round_scheduler.schedule(chat_id, gs.game_id, gs.round.started_at, gs.round.deadline)
+        # в недописанный сегмент не дописываем — начинаем следующий
+        self._open_segment(max(segments + [first]) + 1)
+        self._since_snapshot = replayed
+        if game_states or rematch_states:
+            print(f"♻️ Восстановлено из журнала: {len(game_states)} игр, {len(rematch_states)} рематчей, "
+                  f"{replayed} записей за {(time.perf_counter() - start) * 1000:.0f} мс")
+        threading.Thread(target=self._run, name="state-journal", daemon=True).start()
+
+    def _open_segment(self, n):
+        if self._file:
+            self._file.close()
+        self._segment = n
+        self._file = open(self._segment_path(n), "a", encoding="utf-8")
+
+    def _run(self):
+        while True:
+            time.sleep(JOURNAL_FLUSH_SEC)
+            try:
+                self._flush()
+                if self._since_snapshot and (self._since_snapshot >= JOURNAL_SNAPSHOT_RECORDS
+                                             or time.time() - self._snapshot_at >= JOURNAL_SNAPSHOT_SEC):
+                    self.snapshot()
+            except Exception as e:
+                print(f"❌ Ошибка журнала состояния: {e}")
+
+    def _flush(self):
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+        if not lines:
+            return
+        data = "".join(lines)
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._since_snapshot += len(lines)
+        self.stats["records"] += len(lines)
+        self.stats["bytes"] += len(data.encode("utf-8"))
+        self.stats["fsyncs"] += 1
+
+    def snapshot(self):
+        # новые записи уходят в следующий сегмент; снимок каждого чата берётся
+        # уже после переключения, а повтор записей поверх снимка отсекается по rev
+        self._flush()
+        self._open_segment(self._segment + 1)
+        games, rematches = [], {}
+        for chat_id in set(game_states) | set(rematch_states):
+            with chat_lock(chat_id):
+                gs = game_states.get(chat_id)
+                rs = rematch_states.get(chat_id)
+                if gs:
+                    games.append(gs.to_dict())
+                if rs:
+                    rematches[str(chat_id)] = rs.to_dict()
+        tmp = os.path.join(self.path, "snapshot.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"segment": self._segment, "games": games, "rematches": rematches},
+                      f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, "snapshot.json"))
+        for n in self._segments():
+            if n < self._segment:
+                os.remove(self._segment_path(n))
+        self._since_snapshot = 0
+        self._snapshot_at = time.time()
+        self.stats["snapshots"] += 1
+
+def make_state_store(backend):
+    if backend == "memory":
+        return MemoryStateStore()
+    if backend == "sqlite":
+        return SQLiteStateStore(STATE_DB)
+    if backend == "journal":
+        return JournalStateStore(STATE_JOURNAL_DIR)
+    raise RuntimeError(f"Неизвестный STATE_BACKEND: {backend}")
+
+state_store = make_state_store(STATE_BACKEND)
+
+# Ожидающие long-poll запросы: chat_id -> [Condition, число ждущих], будится
+# из bump_rev(). Запись живёт, пока есть кто ждать: её заводит wait_for_rev
+# только для существующей игры и убирает последний вышедший.
+rev_conditions = {}
+_rev_conditions_lock = threading.Lock()
+
+def notify_rev(chat_id):
+    with _rev_conditions_lock:
+        entry = rev_conditions.get(chat_id)
+    if entry is None:
+        return  # никто не ждёт
+    with entry[0]:
+        entry[0].notify_all()
+
+# Журнал изменений по rev для дельта-ответов get_state: chat_id -> (game_id, deque).
+# Событие — что поменялось: {"players": [uid, ...], "round": True, "plan": True};
+# скалярные поля в дельту кладутся всегда. None — «неизвестно что», только полный снимок.
+DELTA_HISTORY = 64
+rev_events = {}
+
+def record_rev_event(gs, changes):
+    chat_id = gs.chat_id
+    log = rev_events.get(chat_id)
+    if log is None or log[0] != gs.game_id:
+        log = rev_events[chat_id] = (gs.game_id, deque(maxlen=DELTA_HISTORY))
+    log[1].append((gs.rev, changes))
+
+def bump_rev(gs, changes=None):
+    lb = leaderboards.get(gs.chat_id)
+    if lb is not None and (lb.game_id, lb.rev) == (gs.game_id, gs.rev):
+        lb.rev += 1  # индекс остаётся синхронным с состоянием
+    gs.rev += 1
+    gs.touched_at = time.time()
+    record_rev_event(gs, changes)
+    state_cache.pop(gs.chat_id, None)
+    notify_rev(gs.chat_id)
+
+def wait_for_rev(chat_id, since_rev, timeout):
+    # ждём, пока rev не уйдёт от since_rev или игра не закончится;
+    # дедлайн раунда сам поднимет rev через round_scheduler
+    rev = state_store.peek(chat_id)
+    if rev is None or rev != since_rev:
+        return  # ждать нечего — и запись в rev_conditions не нужна
+    with _rev_conditions_lock:
+        entry = rev_conditions.get(chat_id)
+        if entry is None:
+            entry = rev_conditions[chat_id] = [threading.Condition(), 0]
+        entry[1] += 1
+    cond = entry[0]
+    until = time.time() + timeout
+    try:
+        with cond:
+            while True:
+                # перепроверка под cond: bump_rev мог пройти до регистрации
+                rev = state_store.peek(chat_id)
+                if rev is None or rev != since_rev:
+                    return
+                left = until - time.time()
+                if left <= 0:
+                    return
+                if state_store.rev_poll_sec:
+                    left = min(left, state_store.rev_poll_sec)
+                cond.wait(left)
+    finally:
+        with _rev_conditions_lock:
+            entry[1] -= 1
+            # discard_game мог уже убрать запись, а новый ждущий — завести свою
+            if not entry[1] and rev_conditions.get(chat_id) is entry:
+                del rev_conditions[chat_id]
 
 def deep_link(bot_username, chat_id):
     return f"https://t.me/{bot_username}?start=join_{chat_id}"
@@ -197,31 +1728,217 @@ def send_webapp_button_to_user(user_id, chat_id):
     markup.add(InlineKeyboardButton(text="🎮 Открыть квиз", web_app=WebAppInfo(url=url)))
     bot.send_message(user_id, "Открываем квиз! Нажмите кнопку ниже:", reply_markup=markup)
 
+# === Дедлайны раундов ===
+# Один поток с кучей (heapq) следит за дедлайнами, не дожидаясь опроса
+# клиентов, а закрытие раунда (транзакция чата) отдаёт пулу: занятый лок
+# одного чата не задерживает дедлайны остальных. Отмена ленивая: запись в
+# куче сверяется с round_timers.
+ROUND_FINALIZE_WORKERS = int(os.getenv("ROUND_FINALIZE_WORKERS", 4))
+
+class RoundScheduler:
+    def __init__(self):
+        self._heap = []        # (fire_at, seq, chat_id, token)
+        self._timers = {}      # chat_id -> token текущего раунда
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=ROUND_FINALIZE_WORKERS, thread_name_prefix="round-finalize")
+        self.stats = {"scheduled": 0, "fired": 0, "cancelled": 0}
+        threading.Thread(target=self._run, name="round-scheduler", daemon=True).start()
+
+    def schedule(self, chat_id, game_id, started_at, deadline):
+        token = (game_id, started_at)
+        with self._cond:
+            self._timers[chat_id] = token
+            heapq.heappush(self._heap, (deadline - DEADLINE_SLOP_SEC, next(self._seq), chat_id, token))
+            self.stats["scheduled"] += 1
+            self._cond.notify()
+
+    def cancel(self, chat_id):
+        with self._cond:
+            if self._timers.pop(chat_id, None) is not None:
+                self.stats["cancelled"] += 1
+
+    def pending(self):
+        with self._cond:
+            return len(self._timers)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                _, _, chat_id, token = heapq.heappop(self._heap)
+                if self._timers.get(chat_id) != token:
+                    continue  # раунд уже закрыт или заменён следующим
+                del self._timers[chat_id]
+            self._pool.submit(self._fire, chat_id, token)
+
+    def _fire(self, chat_id, token):
+        try:
+            with state_store.transaction(chat_id):
+                gs = game_states.get(chat_id)
+                rnd = gs.round if gs else None
+                if rnd and (gs.game_id, rnd.started_at) == token:
+                    finalize_round_if_needed(gs, chat_id)
+                    with self._cond:
+                        self.stats["fired"] += 1
+        except Exception as e:
+            print(f"❌ Ошибка закрытия раунда по дедлайну ({chat_id}): {e}")
+
+round_scheduler = RoundScheduler()
+
+# Учёт раунда за O(1): старт раунда не обходит игроков, а поднимает эпоху;
+# «ответил в этом раунде» = p.epoch == round.epoch. Время неответивших
+# не начисляется поштучно: длительность каждого раунда сразу идёт в
+# gs.timeout_total, а ответившие копят её в p.timeout_skip.
+
+def player_answered(gs, p):
+    rnd = gs.round
+    return bool(rnd) and p.epoch == rnd.epoch
+
+def player_total_time(gs, p):
+    total = p.answer_time + gs.timeout_total - p.timeout_skip
+    rnd = gs.round
+    if rnd and not rnd.finished and p.epoch != rnd.epoch:
+        total -= rnd.duration  # текущий раунд ещё идёт — штрафовать рано
+    return total
+
+def start_round(gs, chat_id, q, duration):
+    started_at = time.time()
+    deadline = started_at + duration
+    gs.epoch += 1
+    gs.timeout_total += duration
+    gs.round = Round(q, started_at, deadline, duration, gs.epoch)
+    round_scheduler.schedule(chat_id, gs.game_id, started_at, deadline)
+
+def finalize_due(gs):
+    rnd = gs.round
+    if not rnd or rnd.finished:
+        return False
+    return rnd.answered >= len(gs.players) or time.time() >= rnd.deadline - DEADLINE_SLOP_SEC
+
 def finalize_round_if_needed(gs, chat_id):
-    rnd = gs["round"]
-    if not rnd or rnd["finished"]:
-        return
-    now = time.time()
-    all_answered = all(p["answered"] for p in gs["players"].values())
-    timeout = now >= rnd["deadline"] - DEADLINE_SLOP_SEC
-    if not all_answered and not timeout:
+    if not finalize_due(gs):
         return
-
-    rnd["finished"] = True
-    dur = gs["timer_seconds"] or 0
-    for uid, p in gs["players"].items():
-        if not p["answered"]:
-            p["last_answer_time"] = None
-            p["total_time"] += dur
-    bump_rev(gs)
+    rnd = gs.round
+
+    # штраф неответившим уже учтён в timeout_total — см. player_total_time()
+    rnd.finished = True
+    round_scheduler.cancel(chat_id)
+    bump_rev(gs, {"round": True})
+
+@contextlib.contextmanager
+def reading_state(chat_id):
+    """state_store.reading() для опросов состояния; отдаёт ChatState или None.
+    Если раунд пора закрывать, закрывает его в пишущей транзакции и читает уже там."""
+    with state_store.reading(chat_id):
+        gs = game_states.get(chat_id)
+        if gs is None or not finalize_due(gs):
+            yield gs
+            return
+    with state_store.transaction(chat_id):
+        gs = game_states.get(chat_id)
+        if gs:
+            finalize_round_if_needed(gs, chat_id)
+        yield gs
 
 def compute_leaderboard(gs):
     items = []
-    for uid, p in gs["players"].items():
-        items.append((uid, p["name"], gs["scores"].get(uid, 0), round(p.get("total_time", 0.0), 3)))
+    for uid, p in gs.players.items():
+        items.append((uid, p.name, p.score, round(player_total_time(gs, p), 3)))
     items.sort(key=lambda x: (-x[2], x[3], x[1].lower()))
     return items
 
+# === Инкрементальный лидерборд ===
+# Игроки разложены по корзинам очков; внутри корзины — отсортированный список
+# (время, имя, uid). Время берётся как answer_time - timeout_skip: общая для
+# всех часть timeout_total на порядок не влияет, а неответившие в текущем
+# раунде считаются уже оштрафованными. Различных очков не больше числа раундов,
+# поэтому ранг и топ-K — это бинпоиск плюс проход по нескольким корзинам.
+LEADERBOARD_TOP = 10
+
+class Leaderboard:
+    def __init__(self, game_id, rev):
+        self.game_id = game_id
+        self.rev = rev
+        self.buckets = {}     # score -> [(time_key, name_lower, uid)]
+        self.neg_scores = []  # различные очки со знаком минус, по возрастанию
+        self.entries = {}     # uid -> (score, entry)
+
+    def update(self, uid, score, time_key, name):
+        self.remove(uid)
+        entry = (round(time_key, 3), name.lower(), uid)
+        bucket = self.buckets.get(score)
+        if bucket is None:
+            bucket = self.buckets[score] = []
+            bisect.insort(self.neg_scores, -score)
+        bisect.insort(bucket, entry)
+        self.entries[uid] = (score, entry)
+
+    def remove(self, uid):
+        old = self.entries.pop(uid, None)
+        if old is None:
+            return
+        score, entry = old
+        bucket = self.buckets[score]
+        del bucket[bisect.bisect_left(bucket, entry)]
+        if not bucket:
+            del self.buckets[score]
+            self.neg_scores.pop(bisect.bisect_left(self.neg_scores, -score))
+
+    def rank(self, uid):
+        """Место игрока, начиная с 0, или None."""
+        if uid not in self.entries:
+            return None
+        score, entry = self.entries[uid]
+        higher = self.neg_scores[:bisect.bisect_left(self.neg_scores, -score)]
+        return sum(len(self.buckets[-s]) for s in higher) + bisect.bisect_left(self.buckets[score], entry)
+
+    def top(self, k=None):
+        out = []
+        for neg in self.neg_scores:
+            for _, _, uid in self.buckets[-neg]:
+                if k is not None and len(out) >= k:
+                    return out
+                out.append((uid, -neg))
+        return out
+
+leaderboards = {}  # chat_id -> Leaderboard, кеш процесса
+
+def player_time_key(p):
+    return p.answer_time - p.timeout_skip
+
+def leaderboard_for(gs):
+    # индекс валиден, пока все изменения очков/времени проходили через leaderboard_touch()
+    chat_id = gs.chat_id
+    lb = leaderboards.get(chat_id)
+    if lb is None or (lb.game_id, lb.rev) != (gs.game_id, gs.rev):
+        lb = Leaderboard(gs.game_id, gs.rev)
+        for uid, p in gs.players.items():
+            lb.update(uid, p.score, player_time_key(p), p.name)
+        leaderboards[chat_id] = lb
+    return lb
+
+def leaderboard_touch(gs, uid):
+    """Вызывать до bump_rev() при изменении очков/времени/состава игроков."""
+    lb = leaderboards.get(gs.chat_id)
+    if lb is None or (lb.game_id, lb.rev) != (gs.game_id, gs.rev):
+        return  # индекс всё равно будет перестроен при следующем чтении
+    p = gs.players.get(uid)
+    if p is None:
+        lb.remove(uid)
+    else:
+        lb.update(uid, p.score, player_time_key(p), p.name)
+
+def final_leaderboard(gs):
+    rnd = gs.round
+    if rnd and not rnd.finished:
+        # квиз оборвали посреди раунда: неответивших не штрафуем — считаем честно
+        return compute_leaderboard(gs)
+    players = gs.players
+    return [(uid, players[uid].name, score, round(player_total_time(gs, players[uid]), 3))
+            for uid, score in leaderboard_for(gs).top()]
+
 def medals_for_position(pos):
     return ["🥇", "🥈", "🥉"][pos] if pos < 3 else "🎖️"
 
@@ -235,22 +1952,27 @@ def start_cmd(msg):
         except Exception:
             bot.send_message(msg.chat.id, "Не удалось понять, из какой группы вы регистрируетесь.")
             return
-        gs = ensure_chat_state(chat_id)
-        if gs["locked"]:
-            bot.send_message(msg.chat.id, "Квиз уже начался, новых участников добавить нельзя.")
-            return
         uid = msg.from_user.id
         name = msg.from_user.first_name or "Игрок"
-        if uid not in gs["players"]:
-            gs["players"][uid] = {"name": name, "answered": False, "dm_ok": True, "total_time": 0.0, "last_answer_time": None}
-            gs["scores"][uid] = 0
-            bump_rev(gs)
+        with state_store.transaction(chat_id):
+            gs = ensure_chat_state(chat_id)
+            locked = gs.locked
+            is_new = uid not in gs.players
+            if locked:
+                pass
+            elif is_new:
+                gs.players[uid] = Player(name)
+                leaderboard_touch(gs, uid)
+                bump_rev(gs, {"players": [uid]})
+            else:
+                gs.players[uid].dm_ok = True
+                bump_rev(gs, {"players": [uid]})
+        if locked:
+            bot.send_message(msg.chat.id, "Квиз уже начался, новых участников добавить нельзя.")
+        elif is_new:
             bot.send_message(msg.chat.id, f"Отлично, {name}! Вы зарегистрированы в квизе.")
-            try: bot.send_message(chat_id, f"✅ {name} теперь в игре!")
-            except Exception: pass
+            announcer.add(chat_id, "joined", name, f"✅ {name} теперь в игре!")
         else:
-            gs["players"][uid]["dm_ok"] = True
-            bump_rev(gs)
             bot.send_message(msg.chat.id, "Вы уже зарегистрированы. Удачи!")
         return
 
@@ -266,39 +1988,47 @@ def register(msg):
     if msg.chat.type not in ("group", "supergroup"):
         bot.send_message(chat_id, "Команда /register — для группового чата.")
         return
-    gs = ensure_chat_state(chat_id)
-    if gs["locked"]:
-        bot.send_message(chat_id, "Квиз уже начался. Новых участников добавить нельзя.")
-        return
     uid = msg.from_user.id
     name = msg.from_user.first_name or "Игрок"
-    if uid in gs["players"]:
+    with state_store.transaction(chat_id):
+        gs = ensure_chat_state(chat_id)
+        locked = gs.locked
+        already = uid in gs.players
+    if locked:
+        bot.send_message(chat_id, "Квиз уже начался. Новых участников добавить нельзя.")
+        return
+    if already:
         bot.send_message(chat_id, f"{name}, ты уже участвуешь!")
         return
-    bot_username = bot.get_me().username
     try:
         bot.send_message(uid, "Привет! Вы зарегистрированы в квизе. Ожидайте начала игры.")
         dm_ok = True
     except Exception:
         dm_ok = False
-    gs["players"][uid] = {"name": name, "answered": False, "dm_ok": dm_ok, "total_time": 0.0, "last_answer_time": None}
-    gs["scores"][uid] = 0
-    bump_rev(gs)
+    with state_store.transaction(chat_id):
+        gs = ensure_chat_state(chat_id)
+        if gs.locked or uid in gs.players:
+            return
+        gs.players[uid] = Player(name, dm_ok)
+        leaderboard_touch(gs, uid)
+        bump_rev(gs, {"players": [uid]})
     if dm_ok:
-        bot.send_message(chat_id, f"✅ {name} зарегистрировался(лась).")
+        announcer.add(chat_id, "joined", name, f"✅ {name} зарегистрировался(лась).")
     else:
-        link_deep = deep_link(bot_username, chat_id)
-        link_plain = f"https://t.me/{bot_username}"
-        bot.send_message(chat_id, f"⚠️ {name}, открой ЛС с ботом: {link_deep} (или {link_plain}) и нажми Start, затем /register ещё раз.")
+        link_deep = deep_link(bot_username(), chat_id)
+        link_plain = f"https://t.me/{bot_username()}"
+        announcer.add(chat_id, "no_dm", name, f"⚠️ {name}, открой ЛС с ботом: {link_deep} (или {link_plain}) и нажми Start, затем /register ещё раз.")
 
 @bot.message_handler(commands=["status"])
 def status(msg):
     chat_id = msg.chat.id
-    gs = game_states.get(chat_id)
-    if not gs:
+    with state_store.reading(chat_id):
+        gs = game_states.get(chat_id)
+        names = [p.name for p in gs.players.values()] if gs else None
+    if names is None:
         bot.send_message(chat_id, "Игра ещё не создана. Используйте /register.")
         return
-    lines = ["*Участники:*"] + [f"- {p['name']}" for p in gs["players"].values()] or ["— пока никого 😅"]
+    lines = ["*Участники:*"] + [f"- {n}" for n in names] or ["— пока никого 😅"]
     bot.send_message(chat_id, "\n".join(lines))
 
 @bot.message_handler(commands=["quiz"])
@@ -307,77 +2037,191 @@ def quiz(msg):
     if msg.chat.type not in ("group", "supergroup"):
         bot.send_message(chat_id, "Команда /quiz — для группового чата.")
         return
-    gs = ensure_chat_state(chat_id)
-    if not gs["players"]:
+    with state_store.transaction(chat_id):
+        gs = ensure_chat_state(chat_id)
+        if not gs.players:
+            has_players = False
+        else:
+            has_players = True
+            admin_before = gs.admin_id
+            if admin_before is None:
+                gs.admin_id = msg.from_user.id
+                gs.locked = True
+                gs.quiz_started = True
+                bump_rev(gs)
+            players = list(gs.players.items())
+    if not has_players:
         bot.send_message(chat_id, "Сначала зарегистрируйте участников командой /register.")
         return
-    if gs["admin_id"] is None:
-        gs["admin_id"] = msg.from_user.id
-        gs["locked"] = True
-        gs["quiz_started"] = True
-        bump_rev(gs)
+    if admin_before is None:
+        announcer.flush(chat_id)
         bot.send_message(chat_id, f"🚀 Квиз начался! Админ: *{msg.from_user.first_name}*.\nПроверьте ЛС — там кнопка для входа в мини-приложение.")
+    elif admin_before != msg.from_user.id:
+        bot.send_message(chat_id, "Админ уже назначен. Дождитесь его действий.")
     else:
-        if gs["admin_id"] != msg.from_user.id:
-            bot.send_message(chat_id, "Админ уже назначен. Дождитесь его действий.")
-        else:
-            bot.send_message(chat_id, "Вы уже админ этого квиза.")
-    bot_username = bot.get_me().username
-    for uid, p in gs["players"].items():
-        try:
-            send_webapp_button_to_user(uid, chat_id)
-            p["dm_ok"] = True
-        except Exception:
-            p["dm_ok"] = False
-            try:
-                link_deep = deep_link(bot_username, chat_id)
-                link_plain = f"https://t.me/{bot_username}"
-                bot.send_message(chat_id, f"⚠️ {p['name']} — открой ЛС с ботом: {link_deep} (или {link_plain}) и нажми Start.")
-            except Exception:
-                pass
+        bot.send_message(chat_id, "Вы уже админ этого квиза.")
+    for uid, p in players:
+        tg_dispatcher.submit(
+            uid, send_webapp_button_to_user, uid, chat_id,
+            on_ok=lambda uid=uid: dm_status_changed(chat_id, uid, True),
+            on_error=lambda e, uid=uid, name=p.name: dm_failed_warning(chat_id, uid, name),
+        )
+
+def dm_status_changed(chat_id, uid, dm_ok):
+    with state_store.transaction(chat_id):
+        gs = game_states.get(chat_id)
+        p = gs.players.get(uid) if gs else None
+        if p and p.dm_ok != dm_ok:
+            p.dm_ok = dm_ok
+            bump_rev(gs, {"players": [uid]})
+
+def dm_failed_warning(chat_id, uid, name):
+    dm_status_changed(chat_id, uid, False)
+    link_deep = deep_link(bot_username(), chat_id)
+    link_plain = f"https://t.me/{bot_username()}"
+    announcer.add(chat_id, "no_dm", name, f"⚠️ {name} — открой ЛС с ботом: {link_deep} (или {link_plain}) и нажми Start.")
 
 # === API: состояние, управление, ответы ===
+def player_payload(gs, p):
+    return {"name": p.name, "answered": player_answered(gs, p)}
+
+def top_payload(gs):
+    return [{"user_id": uid, "name": gs.players[uid].name, "score": score}
+            for uid, score in leaderboard_for(gs).top(LEADERBOARD_TOP)]
+
+def round_payload(gs):
+    """(question, round) для ответа; правильный ответ — только после конца раунда."""
+    rnd = gs.round
+    if not rnd:
+        return None, None
+    q = rnd.q.copy()
+    if not rnd.finished:
+        q.pop("answer", None)
+        q.pop("correct_text", None)
+    return q, {"started_at": rnd.started_at, "deadline": rnd.deadline, "finished": rnd.finished}
+
 def current_state_payload(gs, chat_id, user_id):
-    role = "admin" if gs["admin_id"] == user_id else "player"
-    rnd = gs["round"]
+    role = "admin" if gs.admin_id == user_id else "player"
+    question, rnd = round_payload(gs)
     payload = {
         "ok": True,
         "role": role,
-        "players": {str(uid): {"name": p["name"], "answered": p["answered"]} for uid, p in gs["players"].items()},
-        "scores": gs["scores"],
-        "quiz_started": gs["quiz_started"],
-        "locked": gs["locked"],
-        "timer_seconds": gs["timer_seconds"],
-        "rounds_total": gs.get("rounds_total", 10),
-        "rounds_played": gs.get("rounds_played", 0),
-        "admin_id": gs["admin_id"],
-        "question": None,
-        "round": None,
-        "rev": gs.get("rev", 0)
+        "players": {str(uid): player_payload(gs, p) for uid, p in gs.players.items()},
+        "scores": {str(uid): p.score for uid, p in gs.players.items()},
+        "quiz_started": gs.quiz_started,
+        "locked": gs.locked,
+        "timer_seconds": gs.timer_seconds,
+        "rounds_total": gs.rounds_total,
+        "rounds_played": gs.rounds_played,
+        "admin_id": gs.admin_id,
+        "question": question,
+        "round": rnd,
+        "top": top_payload(gs),
+        "next_image": next_image_hint(gs, chat_id),
+        "game_id": gs.game_id,
+        "rev": gs.rev
     }
-    if rnd:
-        q = rnd["q"].copy()
-        if not rnd["finished"]:
-            q.pop("answer", None)
-            q.pop("correct_text", None)
-        payload["question"] = q
-        payload["round"] = {"started_at": rnd["started_at"], "deadline": rnd["deadline"], "finished": rnd["finished"]}
-        if rnd["finished"]:
-            payload["question"]["answer"] = rnd["q"]["answer"]
-            payload["question"]["correct_text"] = rnd["q"]["correct_text"]
     return payload
 
+def next_image_hint(gs, chat_id):
+    """Обложка следующего раунда, пока текущий не идёт: клиент успевает
+    прогреть её до конца отсчёта. Во время раунда не шлём — канал нужен
+    текущей картинке."""
+    if gs.round and not gs.round.finished or remaining_rounds(gs) == 0 or not gs.plan:
+        return None
+    anime = catalog_by_id.get(gs.plan[0][0])
+    return image_url(anime) if anime else None
+
+STATE_SCALAR_FIELDS = ("quiz_started", "locked", "timer_seconds", "rounds_total", "rounds_played", "admin_id")
+
+def delta_state_payload(gs, chat_id, user_id, since_rev, game_id):
+    """Патч от since_rev до текущего rev или None, если журнал его уже не покрывает."""
+    rev = gs.rev
+    log = rev_events.get(chat_id)
+    if game_id != gs.game_id or not log or log[0] != game_id or since_rev > rev:
+        return None
+    events = [ch for r, ch in log[1] if r > since_rev]
+    if len(events) != rev - since_rev or any(ch is None for ch in events):
+        return None
+
+    uids = {uid for ch in events for uid in ch.get("players", ())}
+    payload = {
+        "ok": True,
+        "delta": True,
+        "base_rev": since_rev,
+        "rev": rev,
+        "game_id": game_id,
+        "role": "admin" if gs.admin_id == user_id else "player",
+        "players": {str(uid): player_payload(gs, gs.players[uid]) for uid in uids if uid in gs.players},
+        "scores": {str(uid): gs.players[uid].score for uid in uids if uid in gs.players},
+    }
+    for key in STATE_SCALAR_FIELDS:
+        payload[key] = getattr(gs, key)
+    payload["next_image"] = next_image_hint(gs, chat_id)  # план меняется и без событий раунда (admin/config)
+    if uids:
+        payload["top"] = top_payload(gs)
+    if any(ch.get("round") for ch in events):
+        payload["question"], payload["round"] = round_payload(gs)
+    return payload
+
+# Сериализованный ответ get_state на текущий rev:
+# chat_id -> {"game_id": str, "rev": int, (role, gzip): bytes}; сбрасывается в bump_rev()
+state_cache = {}
+
+def state_etag(gs, role):
+    return f'"{gs.game_id}-{gs.rev}-{role}"'
+
+def cached_state_body(gs, chat_id, user_id, role, use_gzip):
+    rev = gs.rev
+    entry = state_cache.get(chat_id)
+    if not entry or (entry["game_id"], entry["rev"]) != (gs.game_id, rev):
+        entry = {"game_id": gs.game_id, "rev": rev}
+        state_cache[chat_id] = entry
+    body = entry.get((role, use_gzip))
+    if body is None:
+        body = entry.get((role, False))
+        start = time.perf_counter()
+        if body is None:
+            body = json.dumps(current_state_payload(gs, chat_id, user_id), ensure_ascii=False).encode("utf-8")
+            entry[(role, False)] = body
+        if use_gzip:
+            body = gzip.compress(body, compresslevel=5)
+            entry[(role, True)] = body
+        record_phase("serialize", time.perf_counter() - start)
+    return body
+
 @app.route("/api/get_state")
 def get_state_api():
     try:
         chat_id = int(request.args.get("chat_id"))
         user_id = int(request.args.get("user_id"))
-        gs = game_states.get(chat_id)
-        if not gs:
-            return jsonify({"ok": False, "ended": True}), 200
-        if gs["round"]:
-            finalize_round_if_needed(gs, chat_id)
-        return jsonify(current_state_payload(gs, chat_id, user_id))
+        since_rev = request.args.get("since_rev")
+        if since_rev is not None:
+            wait = min(LONG_POLL_MAX_SEC, max(0.0, float(request.args.get("wait", LONG_POLL_MAX_SEC))))
+            start = time.perf_counter()
+            wait_for_rev(chat_id, int(since_rev), wait)
+            record_phase("wait", time.perf_counter() - start)
+        with reading_state(chat_id) as gs:
+            if not gs:
+                return jsonify({"ok": False, "ended": True}), 200
+
+            if since_rev is not None and request.args.get("delta") == "1":
+                patch = delta_state_payload(gs, chat_id, user_id, int(since_rev), request.args.get("game_id"))
+                if patch is not None:
+                    return jsonify(patch)
+
+            role = "admin" if gs.admin_id == user_id else "player"
+            etag = state_etag(gs, role)
+            headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+            if etag in request.headers.get("If-None-Match", ""):
+                return Response(status=304, headers=headers)
+
+            accepts_gzip = "gzip" in request.headers.get("Accept-Encoding", "")
+            body = cached_state_body(gs, chat_id, user_id, role, False)
+            if accepts_gzip and len(body) >= STATE_GZIP_MIN_BYTES:
+                body = cached_state_body(gs, chat_id, user_id, role, True)
+                headers["Content-Encoding"] = "gzip"
+        return Response(body, mimetype="application/json", headers=headers)
     except Exception as e:
         print(f"❌ /api/get_state error: {e}")
         return jsonify({"ok": False}), 500
@@ -391,19 +2235,22 @@ def admin_config():
         timer_seconds = int(data["timer_seconds"])
         rounds_total = int(data.get("rounds_total", 10))
 
-        gs = game_states.get(chat_id)
-        if not gs or gs["admin_id"] != user_id:
-            return jsonify({"ok": False, "error": "not admin"}), 403
+        ensure_catalog()  # пустой каталог заливается из AniList не под локом чата
+        with state_store.transaction(chat_id):
+            gs = game_states.get(chat_id)
+            if not gs or gs.admin_id != user_id:
+                return jsonify({"ok": False, "error": "not admin"}), 403
 
-        gs["timer_seconds"] = max(MIN_TIMER, min(MAX_TIMER, timer_seconds))
+            gs.timer_seconds = max(MIN_TIMER, min(MAX_TIMER, timer_seconds))
 
-        allowed_rounds = {10, 15, 20, 30}
-        if rounds_total not in allowed_rounds:
-            rounds_total = 10
-        gs["rounds_total"] = rounds_total
+            allowed_rounds = {10, 15, 20, 30}
+            if rounds_total not in allowed_rounds:
+                rounds_total = 10
+            gs.rounds_total = rounds_total
 
-        bump_rev(gs)
-        return jsonify({"ok": True, "timer_seconds": gs["timer_seconds"], "rounds_total": gs["rounds_total"]})
+            plan_questions(gs, remaining_rounds(gs))
+            bump_rev(gs, {"plan": True})
+            return jsonify({"ok": True, "timer_seconds": gs.timer_seconds, "rounds_total": gs.rounds_total})
     except Exception as e:
         print(f"❌ /api/admin/config error: {e}")
         return jsonify({"ok": False}), 500
@@ -415,91 +2262,94 @@ def admin_start_round():
         chat_id = int(data["chat_id"])
         user_id = int(data["user_id"])
         maybe_timer = data.get("timer_seconds")
-        gs = game_states.get(chat_id)
-        if not gs or gs["admin_id"] != user_id:
-            return jsonify({"ok": False, "error": "not admin"}), 403
-        if not gs["quiz_started"]:
-            return jsonify({"ok": False, "error": "quiz not started"}), 400
-        if not gs.get("timer_seconds"):
-            try:
-                val = int(maybe_timer) if maybe_timer is not None else 30
-            except Exception:
-                val = 30
-            gs["timer_seconds"] = max(MIN_TIMER, min(MAX_TIMER, val))
-
-        # старт первого раунда
-        q = generate_question()
-        started_at = time.time()
-        deadline = started_at + gs["timer_seconds"]
-        gs["round"] = {"q": q, "started_at": started_at, "deadline": deadline, "finished": False}
-        gs["rounds_played"] = 1  # первый раунд начался
-        for p in gs["players"].values():
-            p["answered"] = False
-            p["last_answer_time"] = None
-        bump_rev(gs)
+        ensure_catalog()
+        with state_store.transaction(chat_id):
+            gs = game_states.get(chat_id)
+            if not gs or gs.admin_id != user_id:
+                return jsonify({"ok": False, "error": "not admin"}), 403
+            if not gs.quiz_started:
+                return jsonify({"ok": False, "error": "quiz not started"}), 400
+            if not gs.timer_seconds:
+                try:
+                    val = int(maybe_timer) if maybe_timer is not None else 30
+                except Exception:
+                    val = 30
+                gs.timer_seconds = max(MIN_TIMER, min(MAX_TIMER, val))
+
+            # старт первого раунда; план на всю игру, если админ не задавал число раундов
+            plan_questions(gs, remaining_rounds(gs))
+            q = take_question(gs)
+            start_round(gs, chat_id, q, gs.timer_seconds)
+            gs.rounds_played = 1  # первый раунд начался
+            bump_rev(gs, {"round": True})
         return jsonify({"ok": True})
     except Exception as e:
         print(f"❌ /api/admin/start error: {e}")
         return jsonify({"ok": False}), 500
 
+def finish_quiz(gs, chat_id):
+    """Закрывает игру: рематч-состояние, сброс игры. Вызывается под chat_lock.
+    Возвращает текст итогов для группы и лидерборд."""
+    board = final_leaderboard(gs)
+
+    lines = ["🏁 *Квиз завершён!* Итоговый лидерборд:"]
+    if not board:
+        lines.append("— никого нет в таблице 😅")
+    else:
+        score_groups = {}
+        for _, name, score, ttime in board:
+            score_groups.setdefault(score, []).append((name, ttime))
+        for i, (uid, name, score, ttime) in enumerate(board):
+            medal = medals_for_position(i)
+            addon = f" — по времени: {ttime:.2f} сек" if len(score_groups[score]) > 1 else ""
+            lines.append(f"{medal} *{name}* — {score} балл(ов){addon}")
+
+    # Создаём состояние рематча
+    rematch_states[chat_id] = RematchState(
+        admin_id=gs.admin_id,
+        leaderboard=[
+            {"user_id": uid, "name": name, "score": score, "total_time": ttime}
+            for uid, name, score, ttime in board
+        ],
+    )
+
+    # Сбрасываем текущую игру
+    discard_game(chat_id)
+    return "\n".join(lines), rematch_states[chat_id].leaderboard
+
 @app.route("/api/admin/next", methods=["POST"])
 def admin_next():
     try:
         data = request.get_json(force=True)
         chat_id = int(data["chat_id"])
         user_id = int(data["user_id"])
-        gs = game_states.get(chat_id)
-        if not gs or gs["admin_id"] != user_id:
-            return jsonify({"ok": False, "error": "not admin"}), 403
-
-        if gs["round"] and not gs["round"]["finished"]:
-            finalize_round_if_needed(gs, chat_id)
-
-        # Проверка лимита — если уже сыграли нужное количество, завершаем квиз
-        played = gs.get("rounds_played", 0)
-        total = gs.get("rounds_total", 10)
-        if played >= total:
-            board = compute_leaderboard(gs)
-
-            lines = ["🏁 *Квиз завершён!* Итоговый лидерборд:"]
-            if not board:
-                lines.append("— никого нет в таблице 😅")
+        ensure_catalog()
+        with state_store.transaction(chat_id):
+            gs = game_states.get(chat_id)
+            if not gs or gs.admin_id != user_id:
+                return jsonify({"ok": False, "error": "not admin"}), 403
+
+            if gs.round and not gs.round.finished:
+                finalize_round_if_needed(gs, chat_id)
+
+            # Проверка лимита — если уже сыграли нужное количество, завершаем квиз
+            played = gs.rounds_played
+            total = gs.rounds_total
+            if played >= total:
+                text, leaderboard = finish_quiz(gs, chat_id)
             else:
-                score_groups = {}
-                for _, name, score, ttime in board:
-                    score_groups.setdefault(score, []).append((name, ttime))
-                for i, (uid, name, score, ttime) in enumerate(board):
-                    medal = medals_for_position(i)
-                    addon = f" — по времени: {ttime:.2f} сек" if len(score_groups[score]) > 1 else ""
-                    lines.append(f"{medal} *{name}* — {score} балл(ов){addon}")
-            try:
-                bot.send_message(chat_id, "\n".join(lines))
-            except Exception:
-                pass
+                # Иначе запускаем следующий раунд
+                q = take_question(gs)
+                start_round(gs, chat_id, q, gs.timer_seconds or 30)
+                gs.rounds_played = played + 1
+                bump_rev(gs, {"round": True})
+                return jsonify({"ok": True})
 
-            rematch_states[chat_id] = {
-                "admin_id": gs["admin_id"],
-                "confirmed": {},
-                "leaderboard": [
-                    {"user_id": uid, "name": name, "score": score, "total_time": ttime}
-                    for uid, name, score, ttime in board
-                ],
-                "created_at": time.time()
-            }
-            game_states.pop(chat_id, None)
-            return jsonify({"ok": True, "ended": True, "leaderboard": rematch_states[chat_id]["leaderboard"]})
-
-        # Иначе запускаем следующий раунд
-        q = generate_question()
-        started_at = time.time()
-        deadline = started_at + (gs["timer_seconds"] or 30)
-        gs["round"] = {"q": q, "started_at": started_at, "deadline": deadline, "finished": False}
-        gs["rounds_played"] = played + 1
-        for p in gs["players"].values():
-            p["answered"] = False
-            p["last_answer_time"] = None
-        bump_rev(gs)
-        return jsonify({"ok": True})
+        try:
+            bot.send_message(chat_id, text)
+        except Exception:
+            pass
+        return jsonify({"ok": True, "ended": True, "leaderboard": leaderboard})
     except Exception as e:
         print(f"❌ /api/admin/next error: {e}")
         return jsonify({"ok": False}), 500
@@ -510,43 +2360,22 @@ def admin_end():
         data = request.get_json(force=True)
         chat_id = int(data["chat_id"])
         user_id = int(data["user_id"])
-        gs = game_states.get(chat_id)
-        if not gs or gs["admin_id"] != user_id:
-            return jsonify({"ok": False, "error": "not admin"}), 403
+        with state_store.transaction(chat_id):
+            gs = game_states.get(chat_id)
+            if not gs or gs.admin_id != user_id:
+                return jsonify({"ok": False, "error": "not admin"}), 403
 
-        if gs["round"] and not gs["round"]["finished"]:
-            finalize_round_if_needed(gs, chat_id)
+            if gs.round and not gs.round.finished:
+                finalize_round_if_needed(gs, chat_id)
 
-        board = compute_leaderboard(gs)
+            text, leaderboard = finish_quiz(gs, chat_id)
 
         # Отправка итогов в группу
-        lines = ["🏁 *Квиз завершён!* Итоговый лидерборд:"]
-        if not board:
-            lines.append("— никого нет в таблице 😅")
-        else:
-            score_groups = {}
-            for _, name, score, ttime in board:
-                score_groups.setdefault(score, []).append((name, ttime))
-            for i, (uid, name, score, ttime) in enumerate(board):
-                medal = medals_for_position(i)
-                addon = f" — по времени: {ttime:.2f} сек" if len(score_groups[score]) > 1 else ""
-                lines.append(f"{medal} *{name}* — {score} балл(ов){addon}")
-        bot.send_message(chat_id, "\n".join(lines))
-
-        # Создаём состояние рематча
-        rematch_states[chat_id] = {
-            "admin_id": gs["admin_id"],
-            "confirmed": {},  # uid: name
-            "leaderboard": [
-                {"user_id": uid, "name": name, "score": score, "total_time": ttime}
-                for uid, name, score, ttime in board
-            ],
-            "created_at": time.time()
-        }
-
-        # Сбрасываем текущую игру
-        game_states.pop(chat_id, None)
-        return jsonify({"ok": True, "leaderboard": rematch_states[chat_id]["leaderboard"]})
+        try:
+            bot.send_message(chat_id, text)
+        except Exception:
+            pass
+        return jsonify({"ok": True, "leaderboard": leaderboard})
     except Exception as e:
         print(f"❌ /api/admin/end error: {e}")
         return jsonify({"ok": False}), 500
@@ -558,49 +2387,79 @@ def submit_answer():
         chat_id = int(data["chat_id"])
         user_id = int(data["user"]["id"])
         given = int(data["given"])
-        gs = game_states.get(chat_id)
-        if not gs or not gs.get("round"):
-            return jsonify({"ok": False}), 400
-        rnd = gs["round"]
-        if rnd["finished"]:
-            return jsonify({"ok": False, "error": "round finished"}), 400
-        player = gs["players"].get(user_id)
-        if not player or player["answered"]:
-            return jsonify({"ok": False}), 400
-
-        now = time.time()
-        elapsed = max(0.0, min(now, rnd["deadline"]) - rnd["started_at"])
-        player["last_answer_time"] = elapsed
-        player["answered"] = True
-
-        q = rnd["q"]
-        if given == q["answer"]:
-            gs["scores"][user_id] = gs["scores"].get(user_id, 0) + 1
-        player["total_time"] += elapsed
-
-        finalize_round_if_needed(gs, chat_id)
-        bump_rev(gs)
+        with state_store.transaction(chat_id):
+            gs = game_states.get(chat_id)
+            if not gs or not gs.round:
+                return jsonify({"ok": False}), 400
+            rnd = gs.round
+            if rnd.finished:
+                return jsonify({"ok": False, "error": "round finished"}), 400
+            player = gs.players.get(user_id)
+            if not player or player.epoch == rnd.epoch:
+                return jsonify({"ok": False}), 400
+
+            now = time.time()
+            elapsed = max(0.0, min(now, rnd.deadline) - rnd.started_at)
+            player.last_answer_time = elapsed
+            player.epoch = rnd.epoch
+            rnd.answered += 1
+
+            q = rnd.q
+            if given == q["answer"]:
+                player.score += 1
+            player.answer_time += elapsed
+            player.timeout_skip += rnd.duration
+            leaderboard_touch(gs, user_id)
+
+            finalize_round_if_needed(gs, chat_id)
+            bump_rev(gs, {"players": [user_id]})
         return jsonify({"ok": True})
     except Exception as e:
         print(f"❌ /api/submit error: {e}")
         return jsonify({"ok": False}), 500
 
+@app.route("/api/rank")
+def rank_api():
+    try:
+        chat_id = int(request.args.get("chat_id"))
+        user_id = int(request.args.get("user_id"))
+        with state_store.reading(chat_id):
+            gs = game_states.get(chat_id)
+            if not gs:
+                return jsonify({"ok": False}), 200
+            pos = leaderboard_for(gs).rank(user_id)
+            p = gs.players.get(user_id)
+            return jsonify({"ok": True, "rank": None if pos is None else pos + 1,
+                            "players": len(gs.players), "score": p.score if p else 0})
+    except Exception as e:
+        print(f"❌ /api/rank error: {e}")
+        return jsonify({"ok": False}), 500
+
+@app.route("/api/prefetch_stats")
+def prefetch_stats_api():
+    planned = {str(cid): len(gs.plan) for cid, gs in list(game_states.items()) if gs.plan}
+    with _prefetch_lock:
+        covers = {str(cid): sum(1 for f in futs.values() if f.done() and f.result()) for cid, futs in cover_prefetch.items()}
+        return jsonify({"ok": True, "hits": prefetch_stats["hits"], "misses": prefetch_stats["misses"],
+                        "workers": PREFETCH_WORKERS, "depth": PREFETCH_DEPTH, "planned": planned, "ready": covers})
+
 # === API рематча ===
 @app.route("/api/rematch/state")
 def rematch_state():
     try:
         chat_id = int(request.args.get("chat_id"))
         user_id = int(request.args.get("user_id"))
-        rs = rematch_states.get(chat_id)
-        if not rs:
-            return jsonify({"ok": False}), 200
-        return jsonify({
-            "ok": True,
-            "admin_id": rs["admin_id"],
-            "confirmed": rs["confirmed"],
-            "leaderboard": rs["leaderboard"],
-            "im_in": str(user_id) in rs["confirmed"]
-        })
+        with state_store.reading(chat_id):
+            rs = rematch_states.get(chat_id)
+            if not rs:
+                return jsonify({"ok": False}), 200
+            return jsonify({
+                "ok": True,
+                "admin_id": rs.admin_id,
+                "confirmed": rs.confirmed,
+                "leaderboard": rs.leaderboard,
+                "im_in": str(user_id) in rs.confirmed
+            })
     except Exception as e:
         print(f"❌ /api/rematch/state error: {e}")
         return jsonify({"ok": False}), 500
@@ -612,11 +2471,13 @@ def rematch_join():
         chat_id = int(data["chat_id"])
         user_id = int(data["user_id"])
         name = data.get("name") or "Игрок"
-        rs = rematch_states.get(chat_id)
-        if not rs:
-            return jsonify({"ok": False}), 400
-        rs["confirmed"][str(user_id)] = name
-        return jsonify({"ok": True, "confirmed": rs["confirmed"]})
+        with state_store.transaction(chat_id):
+            rs = rematch_states.get(chat_id)
+            if not rs:
+                return jsonify({"ok": False}), 400
+            rs.confirmed[str(user_id)] = name
+            rs.touched_at = time.time()
+            return jsonify({"ok": True, "confirmed": rs.confirmed})
     except Exception as e:
         print(f"❌ /api/rematch/join error: {e}")
         return jsonify({"ok": False}), 500
@@ -627,11 +2488,13 @@ def rematch_leave():
         data = request.get_json(force=True)
         chat_id = int(data["chat_id"])
         user_id = int(data["user_id"])
-        rs = rematch_states.get(chat_id)
-        if not rs:
-            return jsonify({"ok": False}), 400
-        rs["confirmed"].pop(str(user_id), None)
-        return jsonify({"ok": True, "confirmed": rs["confirmed"]})
+        with state_store.transaction(chat_id):
+            rs = rematch_states.get(chat_id)
+            if not rs:
+                return jsonify({"ok": False}), 400
+            rs.confirmed.pop(str(user_id), None)
+            rs.touched_at = time.time()
+            return jsonify({"ok": True, "confirmed": rs.confirmed})
     except Exception as e:
         print(f"❌ /api/rematch/leave error: {e}")
         return jsonify({"ok": False}), 500
@@ -642,42 +2505,239 @@ def rematch_start():
         data = request.get_json(force=True)
         chat_id = int(data["chat_id"])
         user_id = int(data["user_id"])
-        rs = rematch_states.get(chat_id)
-        if not rs or rs["admin_id"] != user_id:
-            return jsonify({"ok": False, "error": "not admin"}), 403
-        confirmed = rs["confirmed"]
+        with state_store.transaction(chat_id):
+            rs = rematch_states.get(chat_id)
+            if not rs or rs.admin_id != user_id:
+                return jsonify({"ok": False, "error": "not admin"}), 403
+            confirmed = rs.confirmed
+
+            # Создаём новую игру только с подтвердившими
+            gs = ensure_chat_state(chat_id)
+            gs.game_id = os.urandom(4).hex()  # это новая игра, даже если состояние уже создали /register
+            gs.players.clear()
+            gs.epoch = 0
+            gs.timeout_total = 0.0
+            for uid_str, name in confirmed.items():
+                uid = int(uid_str)
+                gs.players[uid] = Player(name)
+            gs.admin_id = rs.admin_id
+            gs.quiz_started = True
+            gs.locked = True
+            gs.timer_seconds = None
+            # rounds_total остаётся прежним, если нужно — админ поменяет в веб-аппе
+            gs.rounds_played = 0
+            gs.round = None
+            gs.plan.clear()  # план соберётся на старте под новое число раундов
+            gs.used_media.clear()
+            drop_covers(chat_id)
+            bump_rev(gs)
+            players = list(gs.players.items())
 
-        # Создаём новую игру только с подтвердившими
-        gs = ensure_chat_state(chat_id)
-        gs["players"].clear()
-        gs["scores"].clear()
-        for uid_str, name in confirmed.items():
-            uid = int(uid_str)
-            gs["players"][uid] = {"name": name, "answered": False, "dm_ok": True, "total_time": 0.0, "last_answer_time": None}
-            gs["scores"][uid] = 0
-        gs["admin_id"] = rs["admin_id"]
-        gs["quiz_started"] = True
-        gs["locked"] = True
-        gs["timer_seconds"] = None
-        gs["rounds_total"] = gs.get("rounds_total", 10)  # останется прежним, если нужно — админ поменяет в веб-аппе
-        gs["rounds_played"] = 0
-        gs["round"] = None
-        bump_rev(gs)
+            # Удаляем состояние рематча
+            rematch_states.pop(chat_id, None)
 
         # Рассылка кнопок в ЛС подтвердившим
-        for uid in gs["players"].keys():
-            try: send_webapp_button_to_user(uid, chat_id)
-            except Exception: pass
-
-        # Удаляем состояние рематча
-        rematch_states.pop(chat_id, None)
+        for uid, p in players:
+            tg_dispatcher.submit(
+                uid, send_webapp_button_to_user, uid, chat_id,
+                on_error=lambda e, uid=uid: dm_status_changed(chat_id, uid, False),
+            )
         return jsonify({"ok": True})
     except Exception as e:
         print(f"❌ /api/rematch/start error: {e}")
         return jsonify({"ok": False}), 500
 
+# === Очистка брошенных игр ===
+# Игры, которые никто не довёл до конца, и неначатые рематчи иначе живут
+# вечно. Фоновый поток раз в SWEEP_INTERVAL_SEC выметает то, что не менялось
+# дольше TTL, а при STATE_MAX_CHATS сверх лимита выселяет давно не тронутые
+# игры (LRU по touched_at). С SQLite-бэкендом кандидаты выбираются из базы
+# (колонка touched_at), лимит — на всю базу, удаление идёт и из базы.
+GAME_IDLE_TTL_SEC = int(os.getenv("GAME_IDLE_TTL_SEC", 6 * 3600))
+REMATCH_IDLE_TTL_SEC = int(os.getenv("REMATCH_IDLE_TTL_SEC", 3600))
+STATE_MAX_CHATS = int(os.getenv("STATE_MAX_CHATS", 0))  # 0 — без ограничения
+SWEEP_INTERVAL_SEC = int(os.getenv("SWEEP_INTERVAL_SEC", 60))
+STATE_SIZE_SAMPLE = 50  # сколько чатов взвешивать для оценки памяти
+
+eviction_stats = {"games_idle": 0, "games_lru": 0, "rematches_idle": 0}
+_eviction_times = deque(maxlen=10000)
+_eviction_lock = threading.Lock()
+
+def discard_game(chat_id):
+    """Убирает игру и все её кеши; ждущие long-poll получат ended. Под state_store.transaction."""
+    game_states.pop(chat_id, None)
+    round_scheduler.cancel(chat_id)
+    drop_covers(chat_id)
+    leaderboards.pop(chat_id, None)
+    state_cache.pop(chat_id, None)
+    rev_events.pop(chat_id, None)
+    notify_rev(chat_id)
+    with _rev_conditions_lock:
+        rev_conditions.pop(chat_id, None)
+
+def record_eviction(kind):
+    with _eviction_lock:
+        eviction_stats[kind] += 1
+        _eviction_times.append(time.time())
+
+def evict_game(chat_id, reason, now):
+    with state_store.transaction(chat_id):
+        gs = game_states.get(chat_id)
+        if gs is None:
+            discard_game(chat_id)  # закрыли в другом процессе — кеши этого всё ещё держат игру
+            return False
+        if reason == "idle" and now - gs.touched_at < GAME_IDLE_TTL_SEC:
+            return False  # успели тронуть
+        notify = bool(gs.players)
+        discard_game(chat_id)
+    record_eviction(f"games_{reason}")
+    if notify:
+        tg_dispatcher.send_message(chat_id, "⌛ Квиз закрыт: слишком долго не было активности. Чтобы сыграть снова — /register.")
+    return True
+
+def evict_rematch(chat_id, now):
+    with state_store.transaction(chat_id):
+        rs = rematch_states.get(chat_id)
+        if rs is None or now - rs.touched_at < REMATCH_IDLE_TTL_SEC:
+            return False
+        rematch_states.pop(chat_id, None)
+    record_eviction("rematches_idle")
+    return True
+
+def sweep_states(now=None):
+    now = now or time.time()
+    # кандидаты — из хранилища (в SQLite это вся база) и из кеша процесса:
+    # игру, закрытую другим воркером, здесь надо хотя бы выкинуть из кешей
+    cutoff = now - GAME_IDLE_TTL_SEC
+    idle = set(state_store.idle_games(cutoff))
+    idle.update(chat_id for chat_id, gs in list(game_states.items()) if gs.touched_at <= cutoff)
+    for chat_id in idle:
+        evict_game(chat_id, "idle", now)
+    cutoff = now - REMATCH_IDLE_TTL_SEC
+    idle = set(state_store.idle_rematches(cutoff))
+    idle.update(chat_id for chat_id, rs in list(rematch_states.items()) if rs.touched_at <= cutoff)
+    for chat_id in idle:
+        evict_rematch(chat_id, now)
+    if STATE_MAX_CHATS:
+        for chat_id in state_store.oldest_games(STATE_MAX_CHATS):
+            evict_game(chat_id, "lru", now)
+
+def state_sweeper_loop():
+    while True:
+        time.sleep(SWEEP_INTERVAL_SEC)
+        try:
+            sweep_states()
+        except Exception as e:
+            print(f"❌ Ошибка очистки состояний: {e}")
+
+def start_state_sweeper():
+    threading.Thread(target=state_sweeper_loop, name="state-sweeper", daemon=True).start()
+
+def deep_sizeof(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(x, seen) for x in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_sizeof(getattr(obj, name), seen) for name in obj.__slots__)
+    return size
+
+def state_bytes_estimate(states):
+    """Оценка памяти по выборке: средний размер чата × число чатов."""
+    chat_ids = list(states)
+    if not chat_ids:
+        return 0
+    sample = random.sample(chat_ids, min(STATE_SIZE_SAMPLE, len(chat_ids)))
+    total = 0
+    for chat_id in sample:
+        with chat_lock(chat_id):
+            total += deep_sizeof(states.get(chat_id), set())
+    return int(total / len(sample) * len(chat_ids))
+
+@app.route("/api/state_stats")
+def state_stats_api():
+    now = time.time()
+    with _eviction_lock:
+        evictions = dict(eviction_stats)
+        per_minute = sum(1 for t in _eviction_times if now - t <= 60)
+    return jsonify({
+        "ok": True,
+        "chats": len(game_states),
+        "players": sum(len(gs.players) for gs in list(game_states.values())),
+        "rematches": len(rematch_states),
+        "bytes_estimate": state_bytes_estimate(game_states) + state_bytes_estimate(rematch_states),
+        "evictions": evictions,
+        "evictions_per_min": per_minute,
+        "game_ttl_sec": GAME_IDLE_TTL_SEC,
+        "rematch_ttl_sec": REMATCH_IDLE_TTL_SEC,
+        "max_chats": STATE_MAX_CHATS,
+    })
+
+# Уже существующая статистика — в /metrics как есть
+Collected("quiz_updates_total", "Апдейты Telegram по исходу", "counter",
+          lambda: {k: v for k, v in update_stats.items() if k != "last_lag_sec"}, ("result",))
+Collected("quiz_update_queue_depth", "Апдейтов в очередях воркеров", "gauge", lambda: sum(q.qsize() for q in update_queues))
+Collected("quiz_prefetch_total", "Взятие вопроса из предзагрузки", "counter", lambda: dict(prefetch_stats), ("result",))
+Collected("quiz_telegram_jobs_total", "Задачи рассыльщика Telegram", "counter", lambda: dict(tg_dispatcher.stats), ("result",))
+Collected("quiz_announcements_total", "Объявления в группах: события, сообщения, сэкономлено", "counter",
+          lambda: dict(announcer.stats), ("result",))
+Collected("quiz_telegram_queue_depth", "Задач в очереди рассыльщика", "gauge", tg_dispatcher.depth)
+Collected("quiz_round_timers_total", "Таймеры раундов", "counter", lambda: dict(round_scheduler.stats), ("event",))
+Collected("quiz_round_timers_pending", "Активных таймеров раундов", "gauge", round_scheduler.pending)
+Collected("quiz_anilist_total", "Клиент AniList: HTTP, кеш, склейка, повторы", "counter",
+          lambda: dict(anilist_client.stats), ("result",))
+Collected("quiz_image_cache_total", "Обращения к кешу обложек", "counter", lambda: dict(image_stats), ("result",))
+Collected("quiz_evictions_total", "Выселенные состояния", "counter", lambda: dict(eviction_stats), ("kind",))
+Collected("quiz_chats", "Живых игр в процессе", "gauge", lambda: len(game_states))
+if STATE_BACKEND == "journal":
+    Collected("quiz_state_journal_total", "Журнал состояния: записи, байты, fsync, снимки", "counter",
+              lambda: dict(state_store.stats), ("result",))
+Collected("quiz_players", "Игроков в живых играх", "gauge", lambda: sum(len(gs.players) for gs in list(game_states.values())))
+Collected("quiz_rematches", "Ожидающих рематчей", "gauge", lambda: len(rematch_states))
+
+# === Фоновые задачи ===
+# Стартуют при импорте, как воркеры апдейтов и планировщик раундов: так их
+# получает и `python app.py`, и каждый воркер gunicorn (без --preload —
+# потоки не переживают fork).
+_background_started = False
+
+def start_background():
+    global _background_started
+    if _background_started:
+        return
+    _background_started = True
+    catalog_seed_if_empty()
+    if STATE_BACKEND == "journal":
+        state_store.restore()
+    if CATALOG_TTL_SEC:
+        start_catalog_refresher()
+    start_state_sweeper()
+
+start_background()
+
 # === Запуск ===
+def serve(port):
+    if SERVER == "gevent":
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+        print(f"🚀 Запускаю gevent WSGI на порту {port} (до {GEVENT_MAX_CONNECTIONS} соединений)")
+        WSGIServer(("0.0.0.0", port), app, spawn=Pool(GEVENT_MAX_CONNECTIONS), log=None).serve_forever()
+    else:
+        print(f"🚀 Запускаю Flask на порту {port}")
+        app.run(host="0.0.0.0", port=port, debug=False)
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["--export-catalog-seed"]:
+        path = sys.argv[2] if len(sys.argv) > 2 else CATALOG_SEED
+        if not catalog_media:
+            sys.exit(f"❌ Каталог {CATALOG_DB} пуст — сначала дайте приложению его обновить")
+        catalog_export_seed(path)
+        print(f"🌱 Seed каталога записан в {path}: {len(catalog_media)} тайтлов")
+        sys.exit(0)
     try:
         bot.remove_webhook()
         time.sleep(1)
@@ -691,6 +2751,4 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"❌ Ошибка вебхука: {e}")
 
-    port = int(os.environ.get("PORT", 10000))
-    print(f"🚀 Запускаю Flask на порту {port}")
-    app.run(host="0.0.0.0", port=port, debug=False)
+    serve(int(os.environ.get("PORT", 10000)))
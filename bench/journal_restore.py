@@ -0,0 +1,128 @@
+"""Журнал состояния переживает падение: игры, начатые с /register, и все
+последующие изменения восстанавливаются как были.
+
+    python bench/journal_restore.py [--chats 40] [--snapshot-sec 1]
+
+Первый процесс (STATE_BACKEND=journal) проигрывает чаты через хендлеры бота
+и API: только /register; /register + /quiz; игра в несколько раундов;
+полная игра с рематчем. Затем ждёт сброса журнала, сохраняет game_states и
+rematch_states и выходит через os._exit — без корректного завершения.
+Второй процесс восстанавливается из того же каталога журнала и сравнивает.
+--snapshot-sec большой — проверяется только повтор журнала, маленький —
+снимок + хвост. Код выхода 1, если состояние разошлось.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+GENRES = ["Action", "Drama", "Comedy", "Romance", "Sci-Fi", "Horror", "Mystery", "Sports"]
+
+def stub_media(i):
+    return {"id": i, "title": {"romaji": f"Title {i}"}, "startDate": {"year": 1980 + i % 44},
+            "genres": [GENRES[i % len(GENRES)]], "studios": {"nodes": [{"name": f"Studio {i % 17}"}]},
+            "characters": {"nodes": [{"name": {"full": f"Hero {i}"}}]},
+            "coverImage": {"extraLarge": None, "large": None, "medium": None, "color": None}, "bannerImage": None}
+
+def import_app():
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import app
+
+    class Me:
+        username = "quizbot"
+    app.bot.send_message = lambda *a, **k: None
+    app.bot.get_me = lambda: Me()
+    return app
+
+def dump(app):
+    return {"games": {str(k): v.to_dict() for k, v in sorted(app.game_states.items())},
+            "rematches": {str(k): v.to_dict() for k, v in sorted(app.rematch_states.items())}}
+
+def command(app, chat_id, uid, text):
+    import telebot
+    update = {"update_id": random.getrandbits(31), "message": {
+        "message_id": 1, "date": int(time.time()), "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        "chat": {"id": chat_id, "type": "group"},
+        "from": {"id": uid, "is_bot": False, "first_name": f"U{uid}"}}}
+    app.bot.process_new_updates([telebot.types.Update.de_json(update)])
+
+def play(app, chat_id, scenario, players):
+    for uid in range(1, players + 1):
+        command(app, chat_id, uid, "/register")
+    if scenario == 0:
+        return
+    command(app, chat_id, 1, "/quiz")
+    if scenario == 1:
+        return
+    client = app.app.test_client()
+    client.post("/api/admin/config", json={"chat_id": chat_id, "user_id": 1, "timer_seconds": 60, "rounds_total": 10})
+    client.post("/api/admin/start", json={"chat_id": chat_id, "user_id": 1})
+    rounds = 3 if scenario == 2 else 10
+    for _ in range(rounds):
+        for uid in random.sample(range(1, players + 1), random.randint(0, players)):
+            client.post("/api/submit", json={"chat_id": chat_id, "user": {"id": uid}, "given": random.randint(0, 3)})
+        client.post("/api/admin/next", json={"chat_id": chat_id, "user_id": 1})
+    if scenario == 3:
+        client.post("/api/rematch/join", json={"chat_id": chat_id, "user_id": 2, "name": "U2"})
+
+def run(args):
+    app = import_app()
+    app.catalog_store([stub_media(i) for i in range(1, 301)], 1)
+    app.catalog_load()
+    for i in range(args.chats):
+        play(app, -3000 - i, i % 4, 3)
+    while app.tg_dispatcher.depth():  # колбэки рассылки тоже меняют состояние
+        time.sleep(0.05)
+    time.sleep(app.JOURNAL_FLUSH_SEC * 5)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(dump(app), f, ensure_ascii=False)
+    print(f"сыграно {args.chats} чатов, журнал: {app.state_store.stats}")
+    sys.stdout.flush()
+    os._exit(0)
+
+def check(args):
+    app = import_app()
+    with open(args.out, encoding="utf-8") as f:
+        live = json.load(f)
+    restored = json.loads(json.dumps(dump(app), ensure_ascii=False))
+    print(f"живое: {len(live['games'])} игр, {len(live['rematches'])} рематчей; "
+          f"восстановлено: {len(restored['games'])} игр, {len(restored['rematches'])} рематчей")
+    diverged = [k for k in live["games"].keys() | restored["games"].keys()
+                if live["games"].get(k) != restored["games"].get(k)]
+    diverged += [f"рематч {k}" for k in live["rematches"].keys() | restored["rematches"].keys()
+                 if live["rematches"].get(k) != restored["rematches"].get(k)]
+    for key in diverged[:10]:
+        print(f"❌ разошёлся чат {key}")
+    sys.stdout.flush()
+    os._exit(1 if diverged else 0)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=40)
+    parser.add_argument("--snapshot-sec", type=int, default=1000)
+    parser.add_argument("--mode", choices=["run", "check"], help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.mode == "run":
+        return run(args)
+    if args.mode == "check":
+        return check(args)
+
+    tmp = tempfile.mkdtemp(prefix="quiz-journal-")
+    env = dict(os.environ, BOT_TOKEN="0:journal", STATE_BACKEND="journal", CATALOG_TTL_SEC="0",
+               CATALOG_DB=os.path.join(tmp, "catalog.sqlite3"), CATALOG_SEED=os.path.join(tmp, "no-seed.json"),
+               STATE_JOURNAL_DIR=os.path.join(tmp, "journal"), JOURNAL_SNAPSHOT_SEC=str(args.snapshot_sec))
+    base = [sys.executable, os.path.abspath(__file__), "--chats", str(args.chats), "--out", os.path.join(tmp, "live.json")]
+    subprocess.run(base + ["--mode", "run"], env=env, check=True)
+    result = subprocess.run(base + ["--mode", "check"], env=env)
+    if result.returncode:
+        sys.exit(1)
+    print("✅ состояние после падения совпадает с живым")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,437 @@
+"""Нагрузочный прогон: M чатов по N игроков играют полный квиз против app.py.
+
+    python bench/load.py [--chats 20] [--players 5] [--rounds 10] [--state memory|sqlite|journal]
+                         [--server dev|gevent] [--idle 2000]
+
+AniList, CDN обложек и Telegram Bot API подменяются локальным HTTP-стендом,
+приложение поднимается отдельным процессом (werkzeug или gevent), чтобы
+клиентские потоки не делили с ним GIL. Каждый чат проходит
+/register -> /quiz (через вебхук) -> /api/admin/config -> /api/admin/start ->
+long-poll /api/get_state + /api/submit -> /api/admin/next -> рематч -> /api/admin/end.
+--idle N держит ещё N открытых long-poll /api/get_state, как свёрнутые
+мини-аппы, — так сравниваются режимы сервера (--server, см. SERVER в app.py).
+В конце — пропускная способность, p50/p99 по эндпоинтам и рост памяти.
+"""
+import os
+import sys
+if "--serve" in sys.argv and os.getenv("SERVER") == "gevent":
+    from gevent import monkey  # процесс приложения: патчим до threading/requests, как app.py
+    monkey.patch_all()
+import argparse
+import http.server
+import itertools
+import json
+import logging
+import random
+import re
+import selectors
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+TMP = tempfile.mkdtemp(prefix="quiz-bench-")
+TOKEN = "123456:bench"
+os.environ.setdefault("BOT_TOKEN", TOKEN)
+os.environ.setdefault("CATALOG_DB", os.path.join(TMP, "catalog.sqlite3"))
+os.environ.setdefault("CATALOG_SEED", os.path.join(TMP, "no-seed.json"))
+os.environ.setdefault("CATALOG_TTL_SEC", "0")  # каталог заливает serve() со стенда
+os.environ.setdefault("IMAGE_CACHE_DIR", os.path.join(TMP, "img"))
+os.environ.setdefault("STATE_DB", os.path.join(TMP, "state.sqlite3"))
+os.environ.setdefault("STATE_JOURNAL_DIR", os.path.join(TMP, "journal"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+CATALOG_PAGES = 6
+GENRES = ["Action", "Drama", "Comedy", "Romance", "Sci-Fi", "Horror", "Mystery", "Sports"]
+
+# === Стенд внешних сервисов ===
+def stub_media(i, origin):
+    return {"id": i, "title": {"romaji": f"Title {i}"}, "startDate": {"year": 1980 + i % 44},
+            "genres": [GENRES[i % len(GENRES)], GENRES[(i * 3 + 1) % len(GENRES)]],
+            "studios": {"nodes": [{"name": f"Studio {i % 17}"}]},
+            "characters": {"nodes": [{"name": {"full": f"Hero {i}"}}, {"name": {"full": f"Side {i}"}}]},
+            "coverImage": {"extraLarge": f"{origin}/img/{i}.jpg", "large": None, "color": None},
+            "bannerImage": None}
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    origin = ""
+    telegram_delay = 0.0
+    message_ids = itertools.count(1)
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/img/"):
+            return self.reply(b"\xff\xd8\xff\xe0" + os.urandom(2048), "image/jpeg")
+        return self.telegram()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+        if self.path == "/graphql":
+            page = json.loads(raw)["variables"]
+            media = [stub_media(page["page"] * 1000 + i, self.origin) for i in range(page["perPage"])]
+            return self.reply(json.dumps({"data": {"Page": {"media": media}}}).encode())
+        return self.telegram()
+
+    def telegram(self):
+        method = self.path.rsplit("/", 1)[-1].split("?")[0]
+        time.sleep(self.telegram_delay)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Quiz", "username": "quizbot"}
+        elif method in ("sendMessage", "sendPhoto"):
+            result = {"message_id": next(self.message_ids), "date": int(time.time()),
+                      "chat": {"id": 0, "type": "private"}}
+        else:
+            result = True
+        self.reply(json.dumps({"ok": True, "result": result}).encode())
+
+def start_stub(telegram_delay):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.handle_error = lambda request, client_address: None  # обрывы keep-alive при остановке приложения
+    StubHandler.origin = f"http://127.0.0.1:{server.server_port}"
+    StubHandler.telegram_delay = telegram_delay
+    threading.Thread(target=server.serve_forever, name="stub", daemon=True).start()
+    return StubHandler.origin
+
+def serve(origin, state):
+    """Процесс приложения: внешние сервисы смотрят на стенд, каталог залит заранее."""
+    os.environ["STATE_BACKEND"] = state
+    import telebot.apihelper
+    telebot.apihelper.API_URL = origin + "/bot{0}/{1}"
+    import app
+    app.anilist_client.url = origin + "/graphql"
+    app.CATALOG_PAGES = CATALOG_PAGES
+    for page in range(1, CATALOG_PAGES + 1):
+        app.catalog_store(app.fetch_anime_page(page), page)
+    app.catalog_load()
+
+    if app.SERVER == "gevent":
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+        server = WSGIServer(("127.0.0.1", 0), app.app, spawn=Pool(app.GEVENT_MAX_CONNECTIONS), log=None)
+        server.start()
+    else:
+        from werkzeug.serving import make_server
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)  # без строки лога на каждый запрос
+        server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    print(f"PORT {server.server_port}", flush=True)
+    server.serve_forever()
+
+def start_app(origin, state, server):
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", origin, "--state", state],
+                            stdout=subprocess.PIPE, text=True, env=dict(os.environ, SERVER=server))
+    for line in proc.stdout:
+        if line.startswith("PORT "):
+            threading.Thread(target=proc.stdout.read, daemon=True).start()  # не даём трубе переполниться
+            return f"http://127.0.0.1:{line.split()[1]}", proc
+    raise RuntimeError("приложение не поднялось")
+
+# === Замеры ===
+class Recorder:
+    def __init__(self):
+        self.samples = {}  # эндпоинт -> [секунды]
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def call(self, session, name, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            resp = session.request(method, url, timeout=60, **kwargs)
+            ok = resp.status_code < 500
+        except requests.RequestException:
+            resp, ok = None, False
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.samples.setdefault(name, []).append(elapsed)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+        return resp
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def server_quantiles(metrics_text):
+    """p50/p99 по маршрутам из гистограммы /metrics (верхняя граница корзины)."""
+    buckets = {}  # route -> {le: n}
+    for line in metrics_text.splitlines():
+        if not line.startswith("quiz_http_request_seconds_bucket{"):
+            continue
+        labels, value = line[line.index("{") + 1:].rsplit("} ", 1)
+        fields = dict(part.split("=", 1) for part in labels.split(","))
+        le = float(fields["le"].strip('"').replace("+Inf", "inf"))
+        per_route = buckets.setdefault(fields["route"].strip('"'), {})
+        per_route[le] = per_route.get(le, 0) + int(value)
+    out = {}
+    for route, counts in buckets.items():
+        bounds = sorted(counts)
+        total = counts[bounds[-1]]
+        out[route] = tuple(next(b for b in bounds if counts[b] >= q * total) for q in (0.5, 0.99))
+    return out
+
+def rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0  # не Linux — память не меряем
+
+# === Сценарий ===
+update_ids = itertools.count(1)
+
+def command_update(chat_id, uid, name, text):
+    return {"update_id": next(update_ids), "message": {
+        "message_id": next(update_ids), "date": int(time.time()), "text": text,
+        "from": {"id": uid, "is_bot": False, "first_name": name},
+        "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]}}
+
+def get_state(rec, s, base, chat_id, uid, since_rev=None, wait=None):
+    params = {"chat_id": chat_id, "user_id": uid}
+    if since_rev is not None:
+        params.update(since_rev=since_rev, wait=wait)
+    resp = rec.call(s, "get_state (long-poll)" if since_rev is not None else "get_state", "GET",
+                    f"{base}/api/get_state", params=params)
+    return resp.json() if resp is not None and resp.status_code == 200 else {"ok": False}
+
+def wait_until(rec, s, base, chat_id, uid, pred, timeout=60):
+    st = get_state(rec, s, base, chat_id, uid)
+    until = time.time() + timeout
+    while not pred(st):
+        if time.time() > until:
+            raise RuntimeError(f"чат {chat_id}: состояние не дождались")
+        if st.get("ok"):
+            st = get_state(rec, s, base, chat_id, uid, st["rev"], 5)
+        else:
+            time.sleep(0.05)
+            st = get_state(rec, s, base, chat_id, uid)
+    return st
+
+def player(rec, base, chat_id, uid, think, done):
+    s = requests.Session()
+    st = wait_until(rec, s, base, chat_id, uid, lambda st: st.get("ok") and st.get("round"))
+    answered = None
+    while True:
+        rnd = st.get("round") if st.get("ok") else None
+        if rnd and not rnd["finished"] and answered != rnd["started_at"]:
+            time.sleep(random.uniform(*think))
+            answered = rnd["started_at"]
+            rec.call(s, "submit", "POST", f"{base}/api/submit",
+                     json={"chat_id": chat_id, "user": {"id": uid}, "given": random.randrange(4)})
+        if not st.get("ok"):
+            break
+        st = get_state(rec, s, base, chat_id, uid, st["rev"], 10)
+    rec.call(s, "rematch/join", "POST", f"{base}/api/rematch/join",
+             json={"chat_id": chat_id, "user_id": uid, "name": f"P{uid}"})
+    done.wait()
+
+def run_chat(rec, base, chat_id, uids, rounds, think, results):
+    s = requests.Session()
+    admin = uids[0]
+    try:
+        for uid in uids:
+            rec.call(s, "webhook /register", "POST", f"{base}/{TOKEN}",
+                     json=command_update(chat_id, uid, f"P{uid}", "/register"))
+        wait_until(rec, s, base, chat_id, admin, lambda st: st.get("ok") and len(st["players"]) == len(uids))
+        rec.call(s, "webhook /quiz", "POST", f"{base}/{TOKEN}", json=command_update(chat_id, admin, "Admin", "/quiz"))
+        wait_until(rec, s, base, chat_id, admin, lambda st: st.get("ok") and st["quiz_started"])
+
+        done = threading.Event()
+        players = [threading.Thread(target=player, args=(rec, base, chat_id, uid, think, done), daemon=True) for uid in uids]
+        for t in players:
+            t.start()
+        rec.call(s, "admin/config", "POST", f"{base}/api/admin/config",
+                 json={"chat_id": chat_id, "user_id": admin, "timer_seconds": 30, "rounds_total": rounds})
+        rec.call(s, "admin/start", "POST", f"{base}/api/admin/start", json={"chat_id": chat_id, "user_id": admin})
+        while True:
+            wait_until(rec, s, base, chat_id, admin, lambda st: not st.get("ok") or st["round"]["finished"])
+            r = rec.call(s, "admin/next", "POST", f"{base}/api/admin/next", json={"chat_id": chat_id, "user_id": admin}).json()
+            if r.get("ended"):
+                break
+        # рематч: ждём, пока все подтвердят, стартуем и сразу закрываем
+        until = time.time() + 30
+        while time.time() < until:
+            rs = rec.call(s, "rematch/state", "GET", f"{base}/api/rematch/state",
+                          params={"chat_id": chat_id, "user_id": admin}).json()
+            if len(rs.get("confirmed", {})) == len(uids):
+                break
+            time.sleep(0.05)
+        done.set()
+        rec.call(s, "rematch/start", "POST", f"{base}/api/rematch/start", json={"chat_id": chat_id, "user_id": admin})
+        rec.call(s, "admin/end", "POST", f"{base}/api/admin/end", json={"chat_id": chat_id, "user_id": admin})
+        for t in players:
+            t.join(timeout=30)
+        results.append(True)
+    except Exception as e:
+        print(f"❌ чат {chat_id}: {e}")
+        results.append(False)
+
+# === Простаивающие мини-аппы ===
+IDLE_CHAT = -99999
+REV_FIELD = re.compile(rb'"rev":\s*(\d+)')
+
+class IdleClients:
+    """N открытых long-poll /api/get_state без потока на каждый: один поток на selectors.
+    Ответ (по истечении long-poll) — сразу новый запрос, как делает мини-апп."""
+
+    def __init__(self, base, count):
+        url = urlsplit(base)
+        self.addr = (url.hostname, url.port)
+        self.count = count
+        self.rev = None
+        self.stats = {"responses": 0, "errors": 0}
+        self.selector = selectors.DefaultSelector()
+        self.stopped = threading.Event()
+
+    def start(self, rev):
+        self.rev = rev
+        for _ in range(self.count):
+            self.open()
+        threading.Thread(target=self.loop, name="idle", daemon=True).start()
+
+    def open(self):
+        try:
+            sock = socket.create_connection(self.addr, timeout=10)
+            path = f"/api/get_state?chat_id={IDLE_CHAT}&user_id=1&since_rev={self.rev}"
+            sock.sendall(f"GET {path} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n".encode())
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, bytearray())
+        except OSError:
+            self.stats["errors"] += 1
+
+    def held(self):
+        return len(self.selector.get_map())
+
+    def loop(self):
+        while not self.stopped.is_set():
+            for key, _ in self.selector.select(timeout=0.5):
+                try:
+                    chunk = key.fileobj.recv(65536)
+                except OSError:
+                    chunk = None
+                if chunk:
+                    key.data.extend(chunk)
+                    continue
+                self.selector.unregister(key.fileobj)
+                key.fileobj.close()
+                ok = chunk == b"" and key.data.startswith((b"HTTP/1.1 200", b"HTTP/1.0 200"))
+                rev = REV_FIELD.search(key.data)
+                if rev:
+                    self.rev = max(self.rev, int(rev.group(1)))  # следующий запрос — от свежего rev
+                self.stats["responses" if ok else "errors"] += 1
+                if not self.stopped.is_set():
+                    self.open()
+
+    def stop(self):
+        self.stopped.set()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+
+def start_idle(base, count):
+    s = requests.Session()
+    s.post(f"{base}/{TOKEN}", json=command_update(IDLE_CHAT, 1, "Idle", "/register"), timeout=30)
+    until = time.time() + 30
+    while time.time() < until:
+        st = s.get(f"{base}/api/get_state", params={"chat_id": IDLE_CHAT, "user_id": 1}, timeout=30).json()
+        if st.get("ok") and st["players"]:
+            break
+        time.sleep(0.05)
+    idle = IdleClients(base, count)
+    idle.start(st["rev"])
+    return idle
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--players", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=10, choices=(10, 15, 20, 30))
+    parser.add_argument("--state", default="memory", choices=("memory", "sqlite", "journal"))
+    parser.add_argument("--server", default="dev", choices=("dev", "gevent"), help="режим сервера приложения")
+    parser.add_argument("--idle", type=int, default=0, help="сколько простаивающих long-poll соединений держать")
+    parser.add_argument("--think", type=float, nargs=2, default=(0.05, 0.3), metavar=("MIN", "MAX"),
+                        help="время на ответ игрока, сек")
+    parser.add_argument("--telegram-delay", type=float, default=0.03, help="задержка ответа стенда Bot API, сек")
+    parser.add_argument("--json", help="записать результат в файл")
+    parser.add_argument("--serve", metavar="ORIGIN", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args.serve, args.state)
+
+    origin = start_stub(args.telegram_delay)
+    base, proc = start_app(origin, args.state, args.server)
+
+    rec = Recorder()
+    rss_before = rss_bytes(proc.pid)
+    idle = start_idle(base, args.idle) if args.idle else None
+    rss_idle = rss_bytes(proc.pid)
+    results = []
+    started = time.perf_counter()
+    chats = [threading.Thread(target=run_chat, daemon=True,
+                              args=(rec, base, -100000 - i, [i * 1000 + p + 1 for p in range(args.players)],
+                                    args.rounds, tuple(args.think), results))
+             for i in range(args.chats)]
+    for t in chats:
+        t.start()
+    for t in chats:
+        t.join()
+    elapsed = time.perf_counter() - started
+    rss_after = rss_bytes(proc.pid)
+    idle_held = idle.held() if idle else 0
+    server = server_quantiles(requests.get(f"{base}/metrics", timeout=10).text)
+    proc.terminate()
+    proc.wait()
+    if idle:
+        idle.stop()
+
+    total = sum(len(v) for v in rec.samples.values())
+    report = {
+        "chats": args.chats, "players": args.players, "rounds": args.rounds, "state": args.state,
+        "server": args.server, "idle": args.idle, "idle_held": idle_held,
+        "idle_responses": idle.stats["responses"] if idle else 0, "idle_errors": idle.stats["errors"] if idle else 0,
+        "rss_idle": rss_idle,
+        "completed": sum(results), "seconds": round(elapsed, 2), "requests": total,
+        "rps": round(total / elapsed, 1), "rss_before": rss_before, "rss_after": rss_after,
+        "endpoints": {name: {"count": len(v), "errors": rec.errors.get(name, 0),
+                             "p50_ms": round(percentile(v, 0.5) * 1000, 2), "p99_ms": round(percentile(v, 0.99) * 1000, 2)}
+                      for name, v in sorted(rec.samples.items())},
+        "server_routes": {route: {"p50_le_ms": q[0] * 1000, "p99_le_ms": q[1] * 1000} for route, q in sorted(server.items())},
+    }
+    print(f"{args.chats} чатов × {args.players} игроков × {args.rounds} раундов, "
+          f"state={args.state}, server={args.server}")
+    if args.idle:
+        print(f"простаивающих соединений: {args.idle}, в конце держится {idle_held}, "
+              f"ответов {report['idle_responses']}, ошибок {report['idle_errors']}; "
+              f"RSS на них +{(rss_idle - rss_before) / 2**20:.1f} МиБ")
+    print(f"завершено {report['completed']}/{args.chats} за {elapsed:.1f} с, {total} запросов, {report['rps']} rps")
+    print(f"RSS: {rss_before / 2**20:.1f} -> {rss_after / 2**20:.1f} МиБ (+{(rss_after - rss_before) / 2**20:.1f})")
+    print(f"{'эндпоинт':<24}{'n':>8}{'ошибок':>8}{'p50, мс':>10}{'p99, мс':>10}")
+    for name, row in report["endpoints"].items():
+        print(f"{name:<24}{row['count']:>8}{row['errors']:>8}{row['p50_ms']:>10}{row['p99_ms']:>10}")
+    print("на сервере (по /metrics, верхняя граница корзины; long-poll включает ожидание):")
+    for route, row in report["server_routes"].items():
+        print(f"{route:<24}{'':>16}{'≤' + format(row['p50_le_ms'], 'g'):>10}{'≤' + format(row['p99_le_ms'], 'g'):>10}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if all(results) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Память на чат и на игрока: словари (как было) против slotted-моделей app.py.
+
+    python bench/memory.py [--chats 20000] [--players 8]
+
+Меряем tracemalloc'ом разницу до/после построения N чатов с M игроками
+в середине раунда. Вопрос раунда общий для всех чатов и в замер не входит.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("CATALOG_DB", ":memory:")
+os.environ.setdefault("CATALOG_TTL_SEC", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+QUESTION = {"type": "title", "image": "https://example.com/x.jpg", "options": ["a", "b", "c", "d"], "answer": 0}
+
+def legacy_chat(chat_id, players, now):
+    # прежняя схема: строковые ключи, очки в параллельном словаре
+    gs = {
+        "chat_id": chat_id, "game_id": os.urandom(4).hex(), "players": {}, "scores": {},
+        "admin_id": 1, "quiz_started": True, "locked": True, "timer_seconds": 30,
+        "rounds_total": 10, "rounds_played": 3, "epoch": 3, "timeout_total": 90.0, "rev": 40,
+        "round": {"q": QUESTION, "started_at": now, "deadline": now + 30.0, "finished": False,
+                  "epoch": 3, "answered": players // 2, "duration": 30},
+    }
+    for uid in range(1, players + 1):
+        gs["players"][uid] = {"name": f"Игрок{uid}", "dm_ok": True, "epoch": 3, "answer_time": uid * 1.5,
+                              "timeout_skip": 60.0 + uid, "last_answer_time": uid * 0.5}
+        gs["scores"][uid] = uid % 4
+    return gs
+
+def slotted_chat(chat_id, players, now):
+    gs = app.ChatState(chat_id, admin_id=1, quiz_started=True, locked=True, timer_seconds=30,
+                       rounds_played=3, epoch=3, timeout_total=90.0, rev=40)
+    gs.round = app.Round(QUESTION, now, now + 30.0, 30, 3, answered=players // 2)
+    for uid in range(1, players + 1):
+        gs.players[uid] = app.Player(f"Игрок{uid}", True, uid % 4, 3, uid * 1.5, 60.0 + uid, uid * 0.5)
+    return gs
+
+def measure(build, chats, players):
+    now = time.time()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    states = {-1000 - i: build(-1000 - i, players, now) for i in range(chats)}
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del states
+    return used
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=20000)
+    parser.add_argument("--players", type=int, default=8)
+    args = parser.parse_args()
+
+    rows = []
+    for label, build in (("dict", legacy_chat), ("slots", slotted_chat)):
+        empty = measure(build, args.chats, 0)
+        full = measure(build, args.chats, args.players)
+        per_chat = empty / args.chats
+        per_player = (full - empty) / (args.chats * args.players) if args.players else 0.0
+        rows.append((label, per_chat, per_player, full / args.chats))
+
+    print(f"{args.chats} чатов × {args.players} игроков")
+    print(f"{'модель':<8}{'байт/чат':>12}{'байт/игрок':>14}{'байт/чат всего':>18}")
+    for label, per_chat, per_player, total in rows:
+        print(f"{label:<8}{per_chat:>12.0f}{per_player:>14.0f}{total:>18.0f}")
+    (_, c0, p0, t0), (_, c1, p1, t1) = rows
+    print(f"экономия: чат {1 - c1 / c0:.0%}, игрок {1 - p1 / p0:.0%}, всего {1 - t1 / t0:.0%}")
+
+if __name__ == "__main__":
+    main()
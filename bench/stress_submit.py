@@ -0,0 +1,160 @@
+"""Стресс /api/submit: параллельные ответы в один раунд не теряют очки и
+не закрывают раунд дважды.
+
+    python bench/stress_submit.py [--state memory|sqlite] [--chats 8] [--players 12] [--rounds 5]
+
+Все игроки всех чатов отвечают в раунд одновременно (барьер), каждый — двумя
+параллельными запросами: засчитаться должен ровно один. Переключение потоков
+учащено (sys.setswitchinterval), проверка «пора закрывать раунд» замедлена,
+чтобы гонки проявлялись. После каждого раунда
+проверяется, что приняты ровно N ответов, раунд закрыт, и закрыт ровно один
+раз; в конце — что очки каждого игрока и их сумма равны числу верных ответов.
+Код выхода 1, если хоть одна проверка не сошлась.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+TMP = tempfile.mkdtemp(prefix="quiz-stress-")
+os.environ.setdefault("BOT_TOKEN", "0:stress")
+os.environ.setdefault("CATALOG_DB", os.path.join(TMP, "catalog.sqlite3"))
+os.environ.setdefault("CATALOG_SEED", os.path.join(TMP, "no-seed.json"))
+os.environ.setdefault("CATALOG_TTL_SEC", "0")
+os.environ.setdefault("STATE_DB", os.path.join(TMP, "state.sqlite3"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+GENRES = ["Action", "Drama", "Comedy", "Romance", "Sci-Fi", "Horror", "Mystery", "Sports"]
+
+def stub_media(i):
+    # без обложек: стресс не ходит в CDN
+    return {"id": i, "title": {"romaji": f"Title {i}"}, "startDate": {"year": 1980 + i % 44},
+            "genres": [GENRES[i % len(GENRES)]], "studios": {"nodes": [{"name": f"Studio {i % 17}"}]},
+            "characters": {"nodes": [{"name": {"full": f"Hero {i}"}}]},
+            "coverImage": {"extraLarge": None, "large": None, "medium": None, "color": None}, "bannerImage": None}
+
+def setup(app, chat_id, players):
+    with app.state_store.transaction(chat_id):
+        gs = app.ensure_chat_state(chat_id)
+        for uid in range(1, players + 1):
+            gs.players[uid] = app.Player(f"P{uid}")
+        gs.admin_id, gs.quiz_started, gs.locked = 1, True, True
+        app.bump_rev(gs)
+    client = app.app.test_client()
+    assert client.post("/api/admin/config", json={"chat_id": chat_id, "user_id": 1, "timer_seconds": app.MAX_TIMER,
+                                                   "rounds_total": 10}).json["ok"]
+    assert client.post("/api/admin/start", json={"chat_id": chat_id, "user_id": 1}).json["ok"]
+
+def current_round(app, chat_id):
+    with app.state_store.reading(chat_id):
+        rnd = app.game_states[chat_id].round
+        return rnd.epoch, rnd.q["answer"], rnd.answered, rnd.finished
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--state", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--chats", type=int, default=8)
+    parser.add_argument("--players", type=int, default=12)
+    parser.add_argument("--rounds", type=int, default=5, help="не больше 10")
+    args = parser.parse_args()
+    os.environ["STATE_BACKEND"] = args.state
+
+    import app
+    app.catalog_store([stub_media(i) for i in range(1, 301)], 1)
+    app.catalog_load()
+
+    # считаем закрытия раунда: finished должен переключиться ровно раз на раунд
+    finalized = {}
+    finalized_lock = threading.Lock()
+    finalize = app.finalize_round_if_needed
+
+    def counting_finalize(gs, chat_id):
+        was = gs.round.finished if gs.round else True
+        finalize(gs, chat_id)
+        if not was and gs.round.finished:
+            with finalized_lock:
+                key = (chat_id, gs.round.epoch)
+                finalized[key] = finalized.get(key, 0) + 1
+    app.finalize_round_if_needed = counting_finalize
+
+    # окно между «пора закрывать» и finished = True расширено: без лока чата
+    # два последних ответа раунда закроют его дважды
+    finalize_due = app.finalize_due
+
+    def slow_finalize_due(gs):
+        due = finalize_due(gs)
+        time.sleep(0.0005)
+        return due
+    app.finalize_due = slow_finalize_due
+
+    chats = [-2000 - i for i in range(args.chats)]
+    for chat_id in chats:
+        setup(app, chat_id, args.players)
+
+    sys.setswitchinterval(1e-6)
+    correct = {(chat_id, uid): 0 for chat_id in chats for uid in range(1, args.players + 1)}
+    failures = []
+    start = time.perf_counter()
+    for r in range(args.rounds):
+        rounds = {chat_id: current_round(app, chat_id) for chat_id in chats}
+        accepted = {chat_id: 0 for chat_id in chats}
+        lock = threading.Lock()
+        barrier = threading.Barrier(args.chats * args.players * 2)
+
+        def player(chat_id, uid):
+            client = app.app.test_client()
+            _, answer, _, _ = rounds[chat_id]
+            given = answer if (uid + r) % 3 else (answer + 1) % 4
+            barrier.wait()
+            resp = client.post("/api/submit", json={"chat_id": chat_id, "user": {"id": uid}, "given": given})
+            if resp.status_code == 200 and resp.json["ok"]:
+                with lock:
+                    accepted[chat_id] += 1
+                    if given == answer:
+                        correct[(chat_id, uid)] += 1
+
+        # у каждого игрока два одновременных ответа: засчитаться должен один
+        threads = [threading.Thread(target=player, args=(chat_id, uid))
+                   for chat_id in chats for uid in range(1, args.players + 1) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for chat_id in chats:
+            epoch = rounds[chat_id][0]
+            _, _, answered, finished = current_round(app, chat_id)
+            closes = finalized.get((chat_id, epoch), 0)
+            if accepted[chat_id] != args.players or answered != args.players or not finished or closes != 1:
+                failures.append(f"чат {chat_id}, раунд {r + 1}: принято {accepted[chat_id]}, "
+                                f"answered={answered}, finished={finished}, закрытий {closes}")
+            if r + 1 < args.rounds:
+                client = app.app.test_client()
+                assert client.post("/api/admin/next", json={"chat_id": chat_id, "user_id": 1}).json["ok"]
+    elapsed = time.perf_counter() - start
+
+    total_expected = sum(correct.values())
+    total_scores = 0
+    for chat_id in chats:
+        with app.state_store.reading(chat_id):
+            gs = app.game_states[chat_id]
+            for uid, p in gs.players.items():
+                total_scores += p.score
+                if p.score != correct[(chat_id, uid)]:
+                    failures.append(f"чат {chat_id}, игрок {uid}: очков {p.score}, верных ответов {correct[(chat_id, uid)]}")
+
+    submits = args.chats * args.players * args.rounds * 2
+    print(f"{args.state}: {args.chats} чатов × {args.players} игроков × {args.rounds} раундов, "
+          f"{submits} submit за {elapsed:.1f} с")
+    print(f"очки: {total_scores} из {total_expected} верных ответов; "
+          f"закрытий раундов: {sum(finalized.values())} из {args.chats * args.rounds}")
+    for line in failures[:20]:
+        print(f"❌ {line}")
+    if failures:
+        sys.exit(1)
+    print("✅ потерянных очков и двойных закрытий нет")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Сборка статики мини-аппа: web/ -> web/dist/.
+
+    python build_web.py [--tailwind путь-или-URL]
+
+Из Tailwind остаются только правила с классами, которые встречаются в
+index.html и app.js; после них дописывается style.css. app.js и CSS получают
+хеш содержимого в имени, рядом кладутся .gz и .br (если установлен brotli).
+app.py отдаёт web/dist/, когда он собран, иначе — исходники из web/ как раньше.
+"""
+import argparse
+import gzip
+import hashlib
+import os
+import re
+import shutil
+
+import requests
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+WEB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "web")
+DIST_DIR = os.path.join(WEB_DIR, "dist")
+TAILWIND_URL = "https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css"
+TAILWIND_LINK = re.compile(r'\s*<link[^>]+tailwindcss[^>]*>')
+CLASS_TOKEN = re.compile(r'[^<>"\'`\s]*[^<>"\'`\s:]')
+CSS_CLASS = re.compile(r'\.((?:\\[0-9a-fA-F]{1,6}\s?|\\.|[\w-])+)')
+CSS_ESCAPE = re.compile(r'\\([0-9a-fA-F]{1,6}\s?|.)')
+
+def read(name):
+    with open(os.path.join(WEB_DIR, name), encoding="utf-8") as f:
+        return f.read()
+
+def load_tailwind(src):
+    if src.startswith(("http://", "https://")):
+        resp = requests.get(src, timeout=30)
+        resp.raise_for_status()
+        return resp.text
+    with open(src, encoding="utf-8") as f:
+        return f.read()
+
+def used_classes(*sources):
+    # как экстрактор Tailwind: любые «слова» из разметки и JS — кандидаты в классы
+    return {tok for text in sources for tok in CLASS_TOKEN.findall(text)}
+
+def css_unescape(name):
+    def unescape(m):
+        code = m.group(1)
+        if re.fullmatch(r'[0-9a-fA-F]{1,6}\s?', code):
+            return chr(int(code, 16))
+        return code
+    return CSS_ESCAPE.sub(unescape, name)
+
+def css_blocks(css):
+    """[(prelude, body)] верхнего уровня; @-директивы без тела попадают в prelude."""
+    blocks, depth, start, brace, quote = [], 0, 0, 0, None
+    for i, ch in enumerate(css):
+        if quote:
+            if ch == quote and css[i - 1] != "\\":
+                quote = None
+        elif ch in "\"'":
+            quote = ch
+        elif ch == "{":
+            if depth == 0:
+                brace = i
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                blocks.append((css[start:brace].strip(), css[brace + 1:i]))
+                start = i + 1
+    return blocks
+
+def split_selectors(prelude):
+    parts, depth, start = [], 0, 0
+    for i, ch in enumerate(prelude):
+        if ch in "([":
+            depth += 1
+        elif ch in ")]":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            parts.append(prelude[start:i])
+            start = i + 1
+    parts.append(prelude[start:])
+    return [p.strip() for p in parts if p.strip()]
+
+def selector_used(selector, used):
+    return all(css_unescape(name) in used for name in CSS_CLASS.findall(selector))
+
+def purge_css(css, used):
+    css = re.sub(r'/\*.*?\*/', "", css, flags=re.S)
+    out = []
+    for prelude, body in css_blocks(css):
+        if ";" in prelude:  # @charset/@import перед правилом
+            head, _, prelude = prelude.rpartition(";")
+            out.append(head + ";")
+        if prelude.startswith(("@media", "@supports")):
+            inner = purge_css(body, used)
+            if inner:
+                out.append(f"{prelude}{{{inner}}}")
+        elif prelude.startswith("@"):
+            out.append(f"{prelude}{{{body}}}")  # @keyframes, @font-face — как есть
+        else:
+            selectors = [s for s in split_selectors(prelude) if selector_used(s, used)]
+            if selectors:
+                out.append(f"{','.join(selectors)}{{{body}}}")
+    return "".join(out)
+
+def write_asset(stem, ext, data):
+    name = f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}.{ext}"
+    path = os.path.join(DIST_DIR, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    with open(path + ".gz", "wb") as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + ".br", "wb") as f:
+            f.write(brotli.compress(data, quality=11))
+    return name
+
+def build(tailwind_src):
+    html, js, style = read("index.html"), read("app.js"), read("style.css")
+    tailwind = load_tailwind(tailwind_src)
+    purged = purge_css(tailwind, used_classes(html, js))
+    licenses = "".join(re.findall(r'/\*!.*?\*/', tailwind, flags=re.S))
+    css = (licenses + purged + "\n" + style).encode("utf-8")
+
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    os.makedirs(DIST_DIR)
+    css_name = write_asset("app", "css", css)
+    js_name = write_asset("app", "js", js.encode("utf-8"))
+
+    html = TAILWIND_LINK.sub("", html)
+    html = html.replace('href="style.css"', f'href="{css_name}"').replace('src="app.js"', f'src="{js_name}"')
+    with open(os.path.join(DIST_DIR, "index.html"), "w", encoding="utf-8") as f:
+        f.write(html)
+
+    print(f"Tailwind: {len(tailwind)} -> {len(purged)} байт после очистки")
+    for name in (css_name, js_name):
+        path = os.path.join(DIST_DIR, name)
+        sizes = [f"{ext or 'raw'} {os.path.getsize(path + ext)}" for ext in ("", ".gz", ".br") if os.path.exists(path + ext)]
+        print(f"{name}: {', '.join(sizes)}")
+    if brotli is None:
+        print("brotli не установлен — .br не собраны")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tailwind", default=TAILWIND_URL, help="tailwind.min.css: путь или URL")
+    build(parser.parse_args().tailwind)
+
+if __name__ == "__main__":
+    main()
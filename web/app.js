@@ -10,7 +10,9 @@ const app = document.getElementById("content");
 
 // === Константы ===
 const POLL_INTERVAL_MS = 3000;
-const DEADLINE_SLOP_MS = 300;
+const LONG_POLL_WAIT_SEC = 25;          // сервер держит запрос, пока не сменится rev
+const LONG_POLL_MAX_FAILURES = 3;       // после стольких ошибок подряд — обратно на опрос
+const LONG_POLL_RETRY_MS = 1000;
 const LOCAL_TIMER_MS = 250;
 const COUNTDOWN_SEC = 3;
 const COUNTDOWN_SKIP_THRESHOLD = 0.2;
@@ -22,7 +24,9 @@ let lastRev = null;
 let inFlight = false;
 let lastAbort = null;
 let pollTimer = null;
-let deadlineTimer = null;
+let longPollActive = false;
+let longPollAbort = null;
+let longPollFailures = 0;
 let localTimer = null;
 let rematchTimer = null;
 
@@ -77,6 +81,13 @@ function setBackground(url){
   };
   img.src = url;
 }
+// Обложка следующего раунда: сервер шлёт её между раундами, греем один раз
+let warmedImage = null;
+function warmNextImage(url){
+  if (!url || url === warmedImage) return;
+  warmedImage = url;
+  preloadImage(url);
+}
 function preloadImage(url){
   return new Promise(resolve=>{
     if (!url){ resolve(true); return; }
@@ -88,13 +99,49 @@ function preloadImage(url){
 }
 
 // ---------- Таймеры ----------
-function startPolling(i=POLL_INTERVAL_MS){ if (!pollTimer) pollTimer = setInterval(()=>getState({soft:true}), i); }
-function stopPolling(){ if (pollTimer){ clearInterval(pollTimer); pollTimer=null; } }
-
-function setDeadlineTimer(deadline){
-  if (deadlineTimer){ clearTimeout(deadlineTimer); deadlineTimer=null; }
-  const delay = Math.max(0, (deadline - nowSec())*1000 + DEADLINE_SLOP_MS);
-  deadlineTimer = setTimeout(()=> getState({soft:true}), delay);
+// Основной канал — long-poll по rev; обычный опрос — запасной вариант
+function startPolling(i=POLL_INTERVAL_MS){
+  if (longPollFailures < LONG_POLL_MAX_FAILURES){ startLongPoll(); return; }
+  if (!pollTimer) pollTimer = setInterval(()=>getState({soft:true}), i);
+}
+function stopPolling(){
+  if (pollTimer){ clearInterval(pollTimer); pollTimer=null; }
+  stopLongPoll();
+}
+function startLongPoll(){
+  if (longPollActive) return;
+  longPollActive = true;
+  longPollLoop();
+}
+function stopLongPoll(){
+  longPollActive = false;
+  if (longPollAbort){ longPollAbort.abort(); longPollAbort = null; }
+}
+async function longPollLoop(){
+  while (longPollActive){
+    longPollAbort = new AbortController();
+    try{
+      const data = await apiGetState(longPollAbort.signal, lastRev ?? 0, lastState?.game_id);
+      longPollFailures = 0;
+      if (!longPollActive) break;
+      if (data.delta){
+        const merged = mergeDelta(lastState, data);
+        if (merged) await applyState(merged, {soft:true});
+        else await getState({soft:false});   // база патча разошлась с нашей — берём полный снимок
+      } else {
+        await applyState(data, {soft:true});
+      }
+    }catch(e){
+      if (!longPollActive) break;
+      longPollFailures++;
+      if (longPollFailures >= LONG_POLL_MAX_FAILURES){
+        stopLongPoll();
+        startPolling(POLL_INTERVAL_MS);
+        break;
+      }
+      await new Promise(r=>setTimeout(r, LONG_POLL_RETRY_MS));
+    }
+  }
 }
 
 function startLocalTimer(deadline, total){
@@ -114,8 +161,11 @@ function startLocalTimer(deadline, total){
 function stopLocalTimer(){ if (localTimer){ clearInterval(localTimer); localTimer=null; } }
 
 // ---------- API ----------
-async function apiGetState(signal){
-  const res = await fetch(`/api/get_state?chat_id=${chat_id}&user_id=${user_id}`, { signal });
+async function apiGetState(signal, sinceRev=null, gameId=null){
+  let wait = sinceRev === null ? "" : `&since_rev=${sinceRev}&wait=${LONG_POLL_WAIT_SEC}`;
+  if (sinceRev !== null && gameId) wait += `&delta=1&game_id=${encodeURIComponent(gameId)}`;
+  const res = await fetch(`/api/get_state?chat_id=${chat_id}&user_id=${user_id}${wait}`, { signal });
+  if (!res.ok) throw new Error(`HTTP ${res.status}`);
   return res.json();
 }
 async function postJSON(url, body){
@@ -565,58 +615,83 @@ async function getState(opts={}){
     lastAbort = new AbortController();
 
     const data = await apiGetState(lastAbort.signal);
+    await applyState(data, opts);
+  }finally{
+    inFlight = false;
+  }
+}
 
-    if (data.ended){
-      stopPolling(); stopLocalTimer();
-      const rs = await apiRematchState();
-      if (rs.ok){
-        renderFinalBoard(rs.leaderboard || []);
-        startRematchWatch();
-      } else {
-        renderLoading("Квиз завершён.");
-        resetBackgroundToDefault();
-      }
-      return;
+// Накладывает дельту (/api/get_state?delta=1) на последний полный снимок
+const DELTA_SCALAR_FIELDS = ["role","quiz_started","locked","timer_seconds","rounds_total","rounds_played","admin_id","top","next_image","game_id","rev"];
+function mergeDelta(base, patch){
+  if (!base || patch.base_rev !== base.rev || patch.game_id !== base.game_id) return null;
+  const next = {...base, players: {...(base.players||{})}, scores: {...(base.scores||{})}};
+  for (const k of DELTA_SCALAR_FIELDS) if (k in patch) next[k] = patch[k];
+  if ("round" in patch){
+    const newRound = patch.round && (!base.round || patch.round.started_at !== base.round.started_at);
+    if (newRound){
+      for (const uid of Object.keys(next.players)) next.players[uid] = {...next.players[uid], answered:false};
     }
-    if (!data.ok){ renderLoading("Игра не найдена."); return; }
+    next.round = patch.round;
+    next.question = patch.question;
+  }
+  Object.assign(next.players, patch.players || {});
+  Object.assign(next.scores, patch.scores || {});
+  return next;
+}
 
-    // если видим, что раунд уже идёт — снимем отсчёт
-    maybeDismissCountdownByState(data);
+async function applyState(data, opts={}){
+  if (data.ended){
+    stopPolling(); stopLocalTimer();
+    const rs = await apiRematchState();
+    if (rs.ok){
+      renderFinalBoard(rs.leaderboard || []);
+      startRematchWatch();
+    } else {
+      renderLoading("Квиз завершён.");
+      resetBackgroundToDefault();
+    }
+    return;
+  }
+  if (!data.ok){ renderLoading("Игра не найдена."); return; }
 
-    // детект нового вопроса
-    const startedAt = data.round?.started_at;
-    const newQuestion = startedAt && (!lastState?.round || startedAt !== lastState.round.started_at);
+  // ответ long-poll мог обогнать более свежий обычный запрос
+  if (opts.soft && lastRev !== null && data.rev < lastRev) return;
 
-    if (newQuestion){
-      const imgUrl = data.question?.image || null;
-      startCountdownForQuestion(startedAt, imgUrl);
-    }
+  // если видим, что раунд уже идёт — снимем отсчёт
+  maybeDismissCountdownByState(data);
+  warmNextImage(data.next_image);
 
-    // обновляем локальное состояние/таймеры
-    if (data.rev !== lastRev || !opts.soft || newQuestion){
-      lastRev = data.rev;
-      lastState = data;
+  // детект нового вопроса
+  const startedAt = data.round?.started_at;
+  const newQuestion = startedAt && (!lastState?.round || startedAt !== lastState.round.started_at);
 
-      // подхватываем текущие настройки (если пришли из бекэнда)
-      if (data.timer_seconds) chosenTimer = data.timer_seconds;
-      if (data.rounds_total) chosenRounds = data.rounds_total;
+  if (newQuestion){
+    const imgUrl = data.question?.image || null;
+    startCountdownForQuestion(startedAt, imgUrl);
+  }
 
-      if (data.round && !data.round.finished) startPolling(POLL_INTERVAL_MS);
-      else stopPolling();
+  // обновляем локальное состояние/таймеры
+  if (data.rev !== lastRev || !opts.soft || newQuestion){
+    lastRev = data.rev;
+    lastState = data;
 
-      if (data.round && !data.round.finished) setDeadlineTimer(data.round.deadline);
-      else if (deadlineTimer){ clearTimeout(deadlineTimer); deadlineTimer=null; }
+    // подхватываем текущие настройки (если пришли из бекэнда)
+    if (data.timer_seconds) chosenTimer = data.timer_seconds;
+    if (data.rounds_total) chosenRounds = data.rounds_total;
 
-      if (countdownActive){
-        showCountdownScreen();
-      } else {
-        if (data.role === "admin") renderAdmin(data);
-        else renderPlayer(data);
-        if (data.question?.image) setBackground(data.question.image);
-      }
+    // long-poll дёшев, поэтому держим его и между раундами;
+    // запасной опрос — как раньше, только пока идёт раунд
+    if (longPollFailures < LONG_POLL_MAX_FAILURES || (data.round && !data.round.finished)) startPolling(POLL_INTERVAL_MS);
+    else stopPolling();
+
+    if (countdownActive){
+      showCountdownScreen();
+    } else {
+      if (data.role === "admin") renderAdmin(data);
+      else renderPlayer(data);
+      if (data.question?.image) setBackground(data.question.image);
     }
-  }finally{
-    inFlight = false;
   }
 }
 
@@ -643,6 +718,14 @@ if (Number.isNaN(chat_id) || Number.isNaN(user_id)) {
   `;
 } else {
   resetBackgroundToDefault();
-  renderLoading();
-  getState({soft:false});
+  // /web/ встраивает состояние в страницу — первый экран без запроса к API
+  const bootstrap = document.getElementById("bootstrap-state");
+  let initial = null;
+  try{ initial = bootstrap && JSON.parse(bootstrap.textContent); }catch(e){}
+  if (initial?.ok){
+    applyState(initial, {soft:false});
+  } else {
+    renderLoading();
+    getState({soft:false});
+  }
 }